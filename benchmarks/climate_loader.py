@@ -0,0 +1,108 @@
+"""
+Compares loading climate data for plotting with pandas (read_sql_query + to_datetime + tz_convert,
+as plot_data used to) against the NumPy loader in climate_series.
+Both read the same synthetic climate.db in a temporary directory.
+
+Usage: python3 benchmarks/climate_loader.py [--sizes 10000 100000 1000000] [--repeat 3]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+import numpy as np  # noqa: E402
+
+from db_utils import init_climate_db  # noqa: E402
+import climate_series  # noqa: E402
+
+START = "2020-01-01 00:00:00"
+END = "2100-01-01 00:00:00"
+
+PANDAS_QUERY = """
+    SELECT timestamp, temperature, co2, humidity
+    FROM climate_data
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY timestamp ASC
+"""
+
+
+def create_db(path, rows):
+    """
+    Fills a climate database with a reading every 3 minutes.
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(init_climate_db)
+    rng = np.random.default_rng(0)
+    epochs = 1577836800 + 180 * np.arange(rows)
+    data = zip((time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(e)) for e in epochs.tolist()),
+               rng.uniform(400, 1200, rows).tolist(),
+               rng.uniform(19, 25, rows).tolist(),
+               rng.uniform(20, 50, rows).tolist())
+    conn.executemany("INSERT INTO climate_data (timestamp, co2, temperature, humidity) VALUES (?, ?, ?, ?)", data)
+    conn.commit()
+    conn.close()
+
+
+def load_pandas(conn):
+    import pandas as pd
+    from zoneinfo import ZoneInfo
+    df = pd.read_sql_query(PANDAS_QUERY, conn, params=(START, END))
+    df['time'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert(ZoneInfo("Europe/Helsinki"))
+    return df
+
+
+def load_numpy(conn):
+    c = conn.cursor()
+    try:
+        return climate_series.fetch_arrays(c, climate_series.RAW_QUERY, (START, END))
+    finally:
+        c.close()
+
+
+def bench(load, conn, repeat):
+    """
+    Returns the best time (s) and the peak Python memory allocation (MB) of a loader.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        load(conn)
+        best = min(best, time.perf_counter() - t)
+    tracemalloc.start()
+    load(conn)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    import pandas  # noqa: F401
+    print(f"import pandas: {(time.perf_counter() - t) * 1000:.0f} ms\n")
+
+    print(f"{'rows':>10} {'pandas s':>10} {'pandas MB':>10} {'numpy s':>10} {'numpy MB':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.sizes:
+            path = os.path.join(tmp, f"climate-{rows}.db")
+            create_db(path, rows)
+            conn = sqlite3.connect(path)
+            pandas_s, pandas_mb = bench(load_pandas, conn, args.repeat)
+            numpy_s, numpy_mb = bench(load_numpy, conn, args.repeat)
+            conn.close()
+            print(f"{rows:>10} {pandas_s:>10.3f} {pandas_mb:>10.1f} {numpy_s:>10.3f} {numpy_mb:>10.1f} "
+                  f"{pandas_s / numpy_s:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares decoding a batch upload from JSON (json.loads + climate_api._parse_reading, as /upload_sensor/batch does)
+against the binary records of climate_api.BINARY_CONTENT_TYPE (struct.iter_unpack + _unpack_reading).
+NumPy frombuffer is shown as the lower bound for just splitting the records into columns.
+Also prints the payload sizes, raw and gzipped.
+
+Usage: python3 benchmarks/ingest_decode.py [--sizes 1 100 1000] [--repeat 200]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.environ.setdefault("SONG_MASTERS", "[]")
+
+import numpy as np  # noqa: E402
+
+import climate_api  # noqa: E402
+
+RECORD_DTYPE = np.dtype([("sensor_id", "<u2"), ("sequence", "<u4"), ("epoch", "<u4"),
+                         ("co2", "<f4"), ("temperature", "<f4"), ("humidity", "<f4")])
+
+
+def make_batch(size):
+    """
+    Returns the same readings as a JSON and a binary body.
+    """
+    rng = random.Random(0)
+    now = int(time.time())
+    records = [(1, i + 1, now - 60 * i, rng.uniform(400, 1200), rng.uniform(19, 25), rng.uniform(20, 50))
+               for i in range(size)]
+    json_body = json.dumps([{"sensor_id": sensor_id, "sequence": sequence, "timestamp": epoch,
+                             "co2": round(co2, 1), "temperature": round(temp, 2), "humidity": round(humidity, 2)}
+                            for sensor_id, sequence, epoch, co2, temp, humidity in records]).encode()
+    binary_body = b"".join(climate_api.BINARY_RECORD.pack(*record) for record in records)
+    return json_body, binary_body
+
+
+def decode_json(body):
+    return [climate_api._parse_reading(item) for item in json.loads(body)]
+
+
+def decode_binary(body):
+    return climate_api.parse_binary(body)
+
+
+def decode_numpy(body):
+    return np.frombuffer(body, dtype=RECORD_DTYPE)
+
+
+def bench(decode, body, repeat):
+    """
+    Returns the best time (s) of decoding a body.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        decode(body)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'readings':>8} {'json B':>8} {'json gz':>8} {'bin B':>8} {'bin gz':>8} "
+          f"{'json/s':>10} {'binary/s':>10} {'numpy/s':>10} {'speedup':>8}")
+    for size in args.sizes:
+        json_body, binary_body = make_batch(size)
+        json_s = bench(decode_json, json_body, args.repeat)
+        binary_s = bench(decode_binary, binary_body, args.repeat)
+        numpy_s = bench(decode_numpy, binary_body, args.repeat)
+        print(f"{size:>8} {len(json_body):>8} {len(gzip.compress(json_body)):>8} "
+              f"{len(binary_body):>8} {len(gzip.compress(binary_body)):>8} "
+              f"{size / json_s:>10.0f} {size / binary_s:>10.0f} {size / numpy_s:>10.0f} "
+              f"{json_s / binary_s:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""
+End-to-end load test of the bot and the climate web app without any network access.
+The bot runs in its own process like in production, but talks to a fake Telegram Bot API server
+(Application.builder().base_url) that hands out scripted commands through getUpdates and records
+the replies (sendMessage, sendPhoto, forwardMessage...). At the same time simulated sensors flood
+/upload_sensor of the web app, also in its own process. Everything uses seeded databases in a temporary directory.
+
+Every simulated chat sends one command at a time and waits for the reply before the next,
+so --concurrency is the amount of users using the bot at once. The latency of a command is
+the time from it being available in getUpdates to the first reply, so it includes polling.
+The scripted commands answer with a single message, a second message would be taken as the reply to the next command.
+
+Usage: python3 benchmarks/loadtest.py [--duration 20] [--concurrency 4] [--sensors 4]
+                                      [--commands "/quote" "/plot 7d" ...]
+"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.environ.setdefault("SONG_MASTERS", "[]")
+
+from aiohttp import web, ClientSession, ClientTimeout  # noqa: E402
+
+TOKEN = "123456:loadtest"
+API_KEY = "loadtest"
+DEFAULT_COMMANDS = ["/quote", "/quote lorem", "/virpi Song 7", "/joke", "/numbers", "/stalk", "/plot", "/plot 7d"]
+# Seconds to wait for the reply to a command before counting it as failed
+REPLY_TIMEOUT = 60
+# Seconds to wait for the bot and the web app to start
+STARTUP_TIMEOUT = 60
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Kiltisbot", "username": "kiltisbot"}
+# Methods that send a message to a chat, the first one after a command is its reply
+REPLY_METHODS = {"sendMessage", "sendPhoto", "forwardMessage", "copyMessage", "sendPoll", "sendDocument"}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, p):
+    """
+    Nearest rank percentile of sorted values.
+    """
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def seed(chats, days):
+    """
+    Creates the databases in the current directory with quotes for every chat, jokes, songs
+    and climate data every 3 minutes for the last days.
+    """
+    from migrations import migrate_all
+    from db_utils import quotedb, jokedb, songdb, Reading, _init_db, _close_db, save_climate_batch
+
+    migrate_all()
+    rng = random.Random(0)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "kilta", "kahvi", "sauna"]
+
+    conn, c = _init_db(quotedb)
+    try:
+        c.executemany("INSERT INTO quotes (quote_text, tags, message_id, chat_id, said_by, added_by, said_date, added_date) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      [(" ".join(rng.choices(words, k=8)), rng.choice(words), i, chat, "load tester", "load tester",
+                        "2025-01-01", "2025-01-01")
+                       for chat in chats for i in range(1, 201)])
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+    conn, c = _init_db(jokedb)
+    try:
+        c.executemany("INSERT INTO jokes (joke_text, tags, date_added) VALUES (?, ?, ?)",
+                      [(" ".join(rng.choices(words, k=12)), rng.choice(words), 0) for _ in range(200)])
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+    conn, c = _init_db(songdb)
+    try:
+        c.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(f"Song {i}", "Melody", "Writer", "Composer", str(i), str(i), " ".join(rng.choices(words, k=40)))
+                       for i in range(1, 101)])
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    readings = []
+    for i in range(days * 24 * 20):
+        timestamp = (now - timedelta(minutes=3 * i)).strftime("%Y-%m-%d %H:%M:%S")
+        readings.append(Reading(timestamp, rng.uniform(400, 1200), rng.uniform(19, 25), rng.uniform(20, 50)))
+    save_climate_batch(readings[::-1])
+
+
+def _quiet():
+    """
+    Hides the prints and info logging of a bot or web app process, they'd drown the report.
+    """
+    sys.stdout = open(os.devnull, "w")
+    logging.disable(logging.INFO)
+
+
+def run_bot(api_url, segment_name):
+    """
+    Runs the bot against the fake Bot API, in its own process.
+    """
+    _quiet()
+    # Complains about the last getUpdates when the bot is stopped
+    logging.getLogger("telegram.ext.Updater").setLevel(logging.CRITICAL)
+    import snapshot
+    snapshot.SEGMENT_NAME = segment_name
+    import kiltisbot
+    import plot_worker
+
+    application = kiltisbot.build_application(TOKEN, base_url=f"{api_url}/bot")
+    plot_worker.start()
+    try:
+        application.run_polling(poll_interval=0, timeout=1, bootstrap_retries=-1)
+    finally:
+        plot_worker.stop()
+
+
+def run_web(port, segment_name):
+    """
+    Runs the climate web app, in its own process.
+    """
+    _quiet()
+    import snapshot
+    snapshot.SEGMENT_NAME = segment_name
+    import climate_api
+    import config
+    config.API_KEY = API_KEY
+
+    web.run_app(climate_api.create_web_app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+class FakeBotAPI:
+    """
+    Just enough of the Telegram Bot API for the bot to poll for commands and reply to them.
+    """
+
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.polling = asyncio.Event()
+        # chat id -> future resolved by the reply to the command sent to that chat
+        self.waiting = {}
+        self.calls = collections.Counter()
+        self._next_id = 1
+
+    def send(self, chat_id, text):
+        """
+        Makes a command available in getUpdates, returns a future resolved by its reply.
+        """
+        update_id = self._next_id
+        self._next_id += 1
+        command = text.split()[0]
+        self.updates.put_nowait({
+            "update_id": update_id,
+            "message": {
+                "message_id": 100000 + update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group", "title": "Load test"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "last_name": "Tester"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        })
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[chat_id] = future
+        return future
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        timeout = min(float(params.get("timeout", 0) or 0), 1.0)
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout)] if timeout else []
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post()) if request.body_exists else {}
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in REPLY_METHODS:
+            chat_id = int(params["chat_id"])
+            future = self.waiting.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+            result = {"message_id": random.randint(1, 2 ** 31), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "group", "title": "Load test"}, "from": BOT_USER}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+async def chat_user(api, chat_id, commands, deadline, latencies, errors):
+    """
+    One user sending commands to the bot one after another.
+    """
+    rng = random.Random(chat_id)
+    while time.perf_counter() < deadline:
+        command = rng.choice(commands)
+        start = time.perf_counter()
+        future = api.send(chat_id, command)
+        try:
+            replied = await asyncio.wait_for(future, REPLY_TIMEOUT)
+            latencies[command].append(replied - start)
+        except asyncio.TimeoutError:
+            errors[command] += 1
+
+
+async def sensor(session, url, sensor_id, deadline, latencies, statuses):
+    """
+    One sensor uploading readings as fast as the web app takes them.
+    """
+    sequence = 0
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    while time.perf_counter() < deadline:
+        sequence += 1
+        reading = {"co2": random.uniform(400, 1200), "temperature": 21.0, "humidity": 30.0,
+                   "sensor_id": sensor_id, "sequence": sequence, "timestamp": time.time()}
+        start = time.perf_counter()
+        try:
+            async with session.post(url, json=reading, headers=headers) as response:
+                await response.read()
+                statuses[response.status] += 1
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+            continue
+        latencies["/upload_sensor"].append(time.perf_counter() - start)
+
+
+async def wait_until_up(api, web_url):
+    """
+    Waits until the bot polls for updates and the web app answers.
+    """
+    deadline = time.perf_counter() + STARTUP_TIMEOUT
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{web_url}/metrics") as response:
+                    if response.status == 200:
+                        break
+            except OSError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError("The web app didn't start")
+            await asyncio.sleep(0.2)
+    await asyncio.wait_for(api.polling.wait(), max(1.0, deadline - time.perf_counter()))
+
+
+def report(title, latencies, errors, duration):
+    print(f"\n{title}")
+    print(f"{'':<16} {'n':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies[name])
+        print(f"{name:<16} {len(values):>7} {errors[name]:>7} {len(values) / duration:>8.1f} "
+              f"{_percentile(values, 50) * 1000:>8.1f} {_percentile(values, 95) * 1000:>8.1f} "
+              f"{_percentile(values, 99) * 1000:>8.1f}")
+
+
+async def run(args, api_port, web_port, segment_name):
+    api = FakeBotAPI()
+    app = web.Application()
+    app.add_routes([web.route("*", "/bot{token}/{method}", api.handle)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    context = multiprocessing.get_context("spawn")
+    # The shared memory of the climate snapshot is kept apart from a bot running on the same machine
+    processes = [context.Process(target=run_bot, args=(f"http://127.0.0.1:{api_port}", segment_name)),
+                 context.Process(target=run_web, args=(web_port, segment_name))]
+    for process in processes:
+        process.start()
+
+    web_url = f"http://127.0.0.1:{web_port}"
+    try:
+        await wait_until_up(api, web_url)
+        print(f"Running for {args.duration} s with {args.concurrency} chats and {args.sensors} sensors...")
+
+        command_latencies, command_errors = collections.defaultdict(list), collections.Counter()
+        sensor_latencies, sensor_statuses = collections.defaultdict(list), collections.Counter()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        async with ClientSession(timeout=ClientTimeout(total=REPLY_TIMEOUT)) as session:
+            await asyncio.gather(
+                *(chat_user(api, -1000 - i, args.commands, deadline, command_latencies, command_errors)
+                  for i in range(args.concurrency)),
+                *(sensor(session, f"{web_url}/upload_sensor", i + 1, deadline, sensor_latencies, sensor_statuses)
+                  for i in range(args.sensors)))
+        duration = time.perf_counter() - start
+
+        report("Commands", command_latencies, command_errors, duration)
+        if args.sensors:
+            sensor_errors = collections.Counter({"/upload_sensor": sum(count for status, count in sensor_statuses.items()
+                                                                       if status != 200)})
+            report("Sensors", sensor_latencies, sensor_errors, duration)
+            print(f"Responses: {dict(sensor_statuses)}")
+        print(f"\nBot API calls: {dict(api.calls)}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="chats sending commands at once")
+    parser.add_argument("--sensors", type=int, default=4, help="sensors uploading at once, 0 for none")
+    parser.add_argument("--commands", nargs="+", default=DEFAULT_COMMANDS)
+    parser.add_argument("--days", type=int, default=7, help="days of climate data to seed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        chats = [-1000 - i for i in range(args.concurrency)]
+        seed(chats, args.days)
+        segment_name = f"kiltisbot_loadtest_{os.getpid()}"
+        try:
+            asyncio.run(run(args, _free_port(), _free_port(), segment_name))
+        finally:
+            from multiprocessing import shared_memory
+            try:
+                shared_memory.SharedMemory(name=segment_name).unlink()
+            except FileNotFoundError:
+                pass
+
+
+if __name__ == '__main__':
+    main()
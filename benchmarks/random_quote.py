@@ -0,0 +1,67 @@
+"""
+Compares picking a random quote of a chat with ORDER BY RANDOM() (what quote._random_msg_id used to do)
+against quote._random_msg_id picking from the cached message ids of the chat.
+The cold time includes reading the ids from the db, which happens only once per chat,
+adding or deleting a quote updates the cached ids.
+
+Usage: python3 benchmarks/random_quote.py [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+os.environ.setdefault("SONG_MASTERS", "[]")
+
+from db_utils import quotedb, _init_db, _close_db  # noqa: E402
+import quote  # noqa: E402
+from search_helpers import CHATS, bench, seed_texts, _create_databases  # noqa: E402
+
+
+def order_by_random(chat_id):
+    conn, c = _init_db(quotedb)
+    try:
+        ret = c.execute("""
+                        SELECT message_id
+                        FROM quotes
+                        WHERE chat_id=?
+                        ORDER BY RANDOM() LIMIT 1
+                        """,
+                        (str(chat_id),)).fetchone()
+    finally:
+        _close_db(conn, c)
+    return ret[0] if ret else None
+
+
+def cold(chat_id):
+    quote._quote_ids.clear()
+    return quote._random_msg_id(chat_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="amounts of quotes, spread over {} chats".format(CHATS))
+    args = parser.parse_args()
+
+    print(f"{'quotes':>9} {'per chat':>9} {'RANDOM() ms':>12} {'cold ms':>10} {'cached ms':>10} {'speedup':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            _create_databases(os.path.join(tmp, f"texts-{size}"))
+            seed_texts(size)
+            old, _ = bench(order_by_random, 1)
+            first, _ = bench(cold, 1)
+            quote._random_msg_id(1)
+            t = time.perf_counter()
+            for _ in range(10_000):
+                quote._random_msg_id(1)
+            cached = (time.perf_counter() - t) / 10_000 * 1000
+            print(f"{size:>9} {size // CHATS:>9} {old:>12.3f} {first:>10.3f} {cached:>10.4f} {old / cached:>8.0f}x")
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Times the sqlite-backed helpers of the bot against synthetic databases of different sizes:
+the quote and joke searches and random picks, the songbook search and reading climate data.
+Each size gets its own databases in a temporary directory, generated with a fixed seed
+so runs on different commits are comparable. The results can be saved as JSON
+and compared against an earlier run to see regressions and the effect of schema changes.
+
+Usage: python3 benchmarks/search_helpers.py [--sizes 10000 100000 1000000] [--climate-years 5]
+                                            [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+os.environ.setdefault("SONG_MASTERS", "[]")
+
+import snapshot  # noqa: E402
+
+# Read the latest climate data from the database, not from a bot running on the same machine
+snapshot.SEGMENT_NAME = f"kiltisbot_benchmark_{os.getpid()}"
+
+from migrations import migrate_all  # noqa: E402
+from db_utils import (quotedb, jokedb, songdb, climatedb, _init_db, _close_db,  # noqa: E402
+                      init_climate_rollup, backfill_climate_rollup)
+import climate  # noqa: E402
+import climate_series  # noqa: E402
+import joke  # noqa: E402
+import quote  # noqa: E402
+import virpi  # noqa: E402
+
+CHATS = 10
+PEOPLE = 200
+SONGS = 600
+VOCABULARY = 5000
+# Every helper is run at least MIN_RUNS times and until it has taken MIN_SECONDS, at most MAX_RUNS times
+MIN_RUNS = 3
+MAX_RUNS = 50
+MIN_SECONDS = 0.5
+
+
+def _words(rng):
+    """
+    A vocabulary where a few words are common and most are rare, like in real text.
+    """
+    vocabulary = [f"w{i}" for i in range(VOCABULARY)]
+    weights = [1 / (i + 1) for i in range(VOCABULARY)]
+    return lambda k: " ".join(rng.choices(vocabulary, weights, k=k))
+
+
+def seed_texts(size):
+    """
+    Fills quote.db and joke.db in the current directory with size quotes and jokes.
+    """
+    rng = random.Random(size)
+    text = _words(rng)
+    people = [f"person {i} surname{i}" for i in range(PEOPLE)]
+
+    conn, c = _init_db(quotedb)
+    try:
+        c.executemany("INSERT INTO quotes (quote_text, tags, message_id, chat_id, said_by, added_by, said_date, added_date) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      ((text(rng.randint(3, 30)), text(rng.randint(0, 3)), i, i % CHATS, rng.choice(people),
+                        rng.choice(people), "2025-01-01", "2025-01-01")
+                       for i in range(size)))
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+    conn, c = _init_db(jokedb)
+    try:
+        c.executemany("INSERT INTO jokes (joke_text, tags, date_added) VALUES (?, ?, ?)",
+                      ((text(rng.randint(5, 60)), text(rng.randint(0, 3)), 0) for _ in range(size)))
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+
+def seed_songs():
+    """
+    Fills song.db in the current directory with a songbook of SONGS songs.
+    """
+    rng = random.Random(0)
+    text = _words(rng)
+    conn, c = _init_db(songdb)
+    try:
+        c.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      ((f"Song {i} {text(2)}", text(3), text(2), text(2), str(i), str(i // 2),
+                        "\n".join(text(8) for _ in range(rng.randint(8, 40))))
+                       for i in range(1, SONGS + 1)))
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+
+def seed_climate(years):
+    """
+    Fills climate.db in the current directory with a reading every 3 minutes for years until now.
+    The rollups are built afterwards in one go, which is much faster than the trigger.
+    """
+    rng = random.Random(0)
+    now = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+    count = int(years * 365 * 24 * 20)
+    conn, c = _init_db(climatedb)
+    try:
+        c.execute("DROP TRIGGER climate_rollup_insert")
+        c.executemany("INSERT INTO climate_data (timestamp, co2, temperature, humidity) VALUES (?, ?, ?, ?)",
+                      (((now - timedelta(minutes=3 * (count - i))).strftime("%Y-%m-%d %H:%M:%S"),
+                        rng.uniform(400, 1200), rng.uniform(19, 25), rng.uniform(20, 50))
+                       for i in range(count)))
+        conn.commit()
+        c.executescript(backfill_climate_rollup + ";" + init_climate_rollup)
+    finally:
+        _close_db(conn, c)
+
+
+def _create_databases(path):
+    """
+    Moves into an empty directory and creates the databases there.
+    """
+    os.mkdir(path)
+    os.chdir(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate_all()
+
+
+def bench(function, *args):
+    """
+    Returns the median and the best time (ms) of calling function(*args).
+    """
+    times = []
+    started = time.perf_counter()
+    while len(times) < MAX_RUNS and (len(times) < MIN_RUNS or time.perf_counter() - started < MIN_SECONDS):
+        t = time.perf_counter()
+        function(*args)
+        times.append((time.perf_counter() - t) * 1000)
+    return statistics.median(times), min(times)
+
+
+def uncached(cache, function):
+    """
+    Calls function with an empty query cache, timing the database instead of the cache.
+    """
+    def call(*args):
+        cache.invalidate()
+        return function(*args)
+    return call
+
+
+def text_cases():
+    """
+    (helper, case, function, args) of the quote and joke helpers.
+    w0 is the most common word, w2000 a rare one and nothing matches "missing".
+    The searches are timed without the query cache except in the "cached" cases.
+    """
+    search_quote = uncached(quote._search_cache, quote._search_msg_id)
+    search_joke = uncached(joke._search_cache, joke._search_joke)
+    return [
+        ("quote._random_msg_id", "", quote._random_msg_id, (1,)),
+        ("quote._search_msg_id", "common", search_quote, (1, ["w0"])),
+        ("quote._search_msg_id", "rare", search_quote, (1, ["w2000"])),
+        ("quote._search_msg_id", "two words", search_quote, (1, ["w3", "w40"])),
+        ("quote._search_msg_id", "person", search_quote, (1, ["surname7"])),
+        ("quote._search_msg_id", "no match", search_quote, (1, ["missing"])),
+        ("quote._search_msg_id", "cached", quote._search_msg_id, (1, ["w0"])),
+        ("joke._random_joke", "", joke._random_joke, ()),
+        ("joke._search_joke", "common", search_joke, (["w0"],)),
+        ("joke._search_joke", "rare", search_joke, (["w2000"],)),
+        ("joke._search_joke", "no match", search_joke, (["missing"],)),
+        ("joke._search_joke", "cached", joke._search_joke, (["w0"],)),
+    ]
+
+
+def song_cases():
+    """
+    (helper, case, function, args) of the songbook search.
+    """
+    search_song = uncached(virpi._search_cache, virpi._search_song)
+    return [
+        ("virpi._search_song", "name", search_song, ("Song 12",)),
+        ("virpi._search_song", "lyrics", search_song, ("w10",)),
+        ("virpi._search_song", "no match", search_song, ("missing",)),
+        ("virpi._search_song", "cached", virpi._search_song, ("Song 12",)),
+    ]
+
+
+def climate_cases():
+    """
+    (helper, case, function, args) of reading the climate data.
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return [
+        ("climate._get_climate_data", "", climate._get_climate_data, ()),
+        ("climate._latest_row_id", "", climate._latest_row_id, ()),
+        ("climate_series.load_climate", "24h", climate_series.load_climate, (now - timedelta(days=1), now, 2000)),
+        ("climate_series.load_climate", "30d", climate_series.load_climate, (now - timedelta(days=30), now, 2000)),
+        ("climate_series.load_climate", "1y", climate_series.load_climate, (now - timedelta(days=365), now, 2000)),
+        ("climate_series.load_climate", "5y", climate_series.load_climate, (now - timedelta(days=5 * 365), now, 2000)),
+    ]
+
+
+def run_cases(cases, size, results):
+    for helper, case, function, args in cases:
+        median, best = bench(function, *args)
+        results.append({"helper": helper, "case": case, "size": size, "median_ms": median, "min_ms": best})
+        print(f"{helper:<30} {case:<10} {size:>9} {median:>10.3f} {best:>10.3f}")
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """
+    Prints how much faster or slower every helper got compared to an earlier run.
+    """
+    with open(path) as f:
+        old = json.load(f)
+    before = {(r["helper"], r["case"], r["size"]): r["median_ms"] for r in old["results"]}
+    print(f"\nCompared to {old.get('commit') or path}:")
+    for r in results:
+        key = (r["helper"], r["case"], r["size"])
+        if key in before:
+            print(f"{r['helper']:<30} {r['case']:<10} {r['size']:>9} {before[key]:>10.3f} -> {r['median_ms']:>10.3f} ms "
+                  f"({before[key] / r['median_ms']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="amounts of quotes and jokes")
+    parser.add_argument("--climate-years", type=float, default=5)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON of an earlier run to compare with")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    results = []
+    print(f"{'helper':<30} {'case':<10} {'size':>9} {'median ms':>10} {'min ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            # Every size in its own directory, the database paths are relative
+            _create_databases(os.path.join(tmp, f"texts-{size}"))
+            seed_texts(size)
+            run_cases(text_cases(), size, results)
+
+        _create_databases(os.path.join(tmp, "other"))
+        seed_songs()
+        run_cases(song_cases(), SONGS, results)
+        seed_climate(args.climate_years)
+        run_cases(climate_cases(), int(args.climate_years * 365 * 24 * 20), results)
+        os.chdir(BOT_DIR)
+
+    report = {
+        "commit": _commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved to {output}")
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
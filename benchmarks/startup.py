@@ -0,0 +1,80 @@
+"""
+Measures how long importing the bot takes and how much memory it needs.
+Every run is a fresh interpreter, so the numbers are those of a cold start.
+
+Usage: python3 benchmarks/startup.py [--runs 10] [--module kiltisbot] [--top 15]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+
+# Imports the module and prints the wall time and the peak RSS (in kB on Linux) of the process
+_MEASURE = """
+import resource, sys, time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    # config.py needs this to be set
+    env.setdefault("SONG_MASTERS", "[]")
+    return env
+
+
+def measure(module, runs):
+    """
+    Returns lists of import times (s) and peak RSS (kB) of separate cold imports.
+    """
+    times, rss = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", _MEASURE.format(module=module)],
+                             cwd=BOT_DIR, env=_env(), capture_output=True, text=True, check=True).stdout
+        seconds, kilobytes = out.split()
+        times.append(float(seconds))
+        rss.append(int(kilobytes))
+    return times, rss
+
+
+def slowest_imports(module, top):
+    """
+    Returns the top slowest imports (cumulative microseconds, name) from -X importtime.
+    """
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=BOT_DIR, env=_env(), capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--module", default="kiltisbot")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    times, rss = measure(args.module, args.runs)
+    print(f"import {args.module} ({args.runs} runs)")
+    print(f"  time: median {statistics.median(times) * 1000:.0f} ms, "
+          f"min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms")
+    print(f"  peak RSS: median {statistics.median(rss) / 1024:.1f} MB")
+
+    print("\nSlowest imports (cumulative):")
+    for cumulative, name in slowest_imports(args.module, args.top):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
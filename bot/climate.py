@@ -1,30 +1,49 @@
-import sqlite3
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
+from db_utils import climatedb, _init_db, _close_db
 from logger import logger
 from zoneinfo import ZoneInfo
 
-import plot_data
-from datetime import datetime
+import occupancy
+import snapshot
+
+import plot_worker
+from datetime import datetime, timedelta
+from render_cache import RenderCache
+
+# Rendered plots, reused until new climate data arrives
+_plot_cache = RenderCache()
+
+# Units of relative time ranges for /plot, e.g. /plot 7d
+_PLOT_UNITS = {"h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1)}
+_PLOT_USAGE = ("<b>How to use:</b>\n"
+               "/plot <i>(last 24h)</i>\n"
+               "/plot 12h | 7d | 4w\n"
+               "/plot 2025-01-01 <i>(until now)</i>\n"
+               "/plot 2025-01-01 2025-02-01")
 
 
 def _get_climate_data():
     """
     Retrieve data from the database and return it as a list.
     [temperature, co2, humidity, timestamp]
+    The latest reading is read from the memory shared with the web process when available.
     """
+    latest = snapshot.latest()
+    if latest:
+        epoch, co2, temp, humidity = latest
+        return [temp, int(co2), humidity, snapshot.to_timestamp(epoch)]
+
+    conn, c = _init_db(climatedb)
     try:
-        conn = sqlite3.connect("climate.db")
-        cursor = conn.cursor()
-        cursor.execute("""
+        c.execute("""
             SELECT temperature, co2, humidity, timestamp
             FROM climate_data
             ORDER BY timestamp DESC LIMIT 1
             """)
 
-        row = cursor.fetchone()
-        conn.close()
+        row = c.fetchone()
 
         if row:
             # row = (temp, co2, humidity, timestamp)
@@ -35,18 +54,38 @@ def _get_climate_data():
     except Exception as e:
         print("DB error:", e)
         return [0, 0, 0, None]
+    finally:
+        _close_db(conn, c)
+
+
+def _latest_row_id():
+    """
+    Id of the newest climate data row, changes whenever new data is saved.
+    """
+    conn, c = _init_db(climatedb)
+    try:
+        return c.execute("SELECT MAX(id) FROM climate_data").fetchone()[0]
+    finally:
+        _close_db(conn, c)
 
 
-def _get_ppl():
+def _get_ppl(co=None):
     """
-    Reads the most recent climate data from the guildroom
-    and then predicts the amount of people at the guildroom.
-    The current model is linear and not very accurate, but it'll do for now.
-    (Also gives out negatives values with low enough ppm, which imo is kinda funny)
+    Returns the estimated amount of people at the guildroom.
+    The estimate is kept up to date by the web process as readings arrive (see occupancy.py).
+    Without one the old linear model of the most recent CO2 level is used,
+    which also gives out negatives values with low enough ppm (imo kinda funny).
     """
-    co = _get_climate_data()[1]
+    humans = snapshot.people()
+    if humans is None:
+        humans = occupancy.saved_estimate()
+    if humans is not None:
+        return round(humans, 2)
+
+    if co is None:
+        co = _get_climate_data()[1]
     if co != 0:
-        humans = round(0.018966699 * int(co) - 8.308014998, 2)
+        humans = round(occupancy.LEGACY_SLOPE * int(co) - occupancy.LEGACY_OFFSET, 2)
     else:
         humans = 0
     return humans
@@ -57,14 +96,14 @@ async def people_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     Returns a simple value as the expected occupancy of the guildroom.
     The value is counted in the function above.
     """
-    ts = _get_climate_data()[3]
+    _, co, _, ts = _get_climate_data()
     dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
     dt_utc = dt.replace(tzinfo=ZoneInfo("UTC"))
     dt_helsinki = dt_utc.astimezone(ZoneInfo("Europe/Helsinki"))
     formatted_dt = dt_helsinki.strftime("%d.%m.%Y at %H:%M")
     await update.message.reply_text(f"<u><b>{formatted_dt}</b></u>\n"
                                     f"<b>Occupancy:</b>\n"
-                                    f"~<i>{_get_ppl()}</i>",
+                                    f"~<i>{_get_ppl(co)}</i>",
                                     parse_mode="HTML")
 
 
@@ -89,24 +128,62 @@ async def guild_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                                     f"<b>CO2:</b> <i>{co}ppm</i>\n"
                                     f"<b>Temperature:</b> <i>{temp}°C</i>\n"
                                     f"<b>Humidity:</b> <i>{hum}%</i>\n"
-                                    f"<b>People:</b> ~<i>{_get_ppl()}</i>\n",
+                                    f"<b>People:</b> ~<i>{_get_ppl(co)}</i>\n",
                                     parse_mode="HTML")
     return
 
 
+def _parse_plot_range(args):
+    """
+    Returns the start, end and label of the time range given after /plot.
+    Either nothing (last 24h), a relative range like 12h, 7d or 4w or
+    one or two dates (YYYY-MM-DD) in Helsinki time, the end date being exclusive.
+    Raises ValueError for anything else.
+    """
+    tz = ZoneInfo("Europe/Helsinki")
+    now = datetime.now(tz)
+    if not args:
+        return now - timedelta(days=1), now, "24h"
+
+    arg = args[0].lower()
+    if len(args) == 1 and arg[-1:] in _PLOT_UNITS and arg[:-1].isdigit() and int(arg[:-1]) > 0:
+        try:
+            return now - int(arg[:-1]) * _PLOT_UNITS[arg[-1]], now, arg
+        except OverflowError:
+            raise ValueError("Time range too long")
+
+    if len(args) > 2:
+        raise ValueError("Too many arguments")
+    start = datetime.strptime(args[0], "%Y-%m-%d").replace(tzinfo=tz)
+    end = datetime.strptime(args[1], "%Y-%m-%d").replace(tzinfo=tz) if len(args) == 2 else now
+    if end <= start:
+        raise ValueError("The end must be after the start")
+    return start, end, None
+
+
 async def get_plot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Draws and returns a plot of the climate data from the guildroom.
-    Showing the last 24h by default but can be adjusted manually.
+    Showing the last 24h by default but can be adjusted manually,
+    e.g. /plot 7d or /plot 2025-01-01 2025-02-01
     """
+    args = update.message.text.split()[1:]
+    try:
+        t_start, t_end, label = _parse_plot_range(args)
+    except ValueError:
+        await update.message.reply_text(_PLOT_USAGE, parse_mode="HTML")
+        return
+
+    async def render():
+        return await plot_worker.render(t_start, t_end, label)
+
     try:
-        plot_data.plotting()
+        pic = await _plot_cache.get((tuple(args), _latest_row_id()), render)
     except Exception as e:
         await update.message.reply_text(f"Plotting failed: {e}")
         return
 
     try:
-        with open("./plots/newest.png", "rb") as pic:
-            await update.get_bot().send_photo(chat_id=update.message.chat_id, photo=pic)
+        await update.get_bot().send_photo(chat_id=update.message.chat_id, photo=pic)
     except Exception as e:
         await update.message.reply_text(f"Sending photo failed: {e}")
@@ -1,46 +1,334 @@
 from aiohttp import web
+import asyncio
 import json
+import math
+import struct
+import time
+from datetime import datetime, timedelta, timezone
 import config  # Optionally define the API_KEY here
-from db_utils import save_climate_data  # Or make your own function to save to a database
+from db_utils import Reading, get_climate_since
+from ingest import IngestQueue  # Saves the readings to a database in the background
+from logger import logger
+import metrics
+import occupancy
+import snapshot
+import stream  # Pushes the readings to live clients
 
+# Upper limit for readings in one batch upload
+MAX_BATCH_SIZE = 1000
 
-async def upload_sensor(request):
+# Compact alternative to JSON for batch uploads, selected with the Content-Type header.
+# The body is a sequence of little-endian records of sensor id (uint16), sequence (uint32, 0 = none),
+# unix epoch (uint32, 0 = time of arrival, not allowed with a sequence), co2, temperature and humidity (float32)
+BINARY_CONTENT_TYPE = "application/vnd.kiltisbot.climate"
+BINARY_RECORD = struct.Struct("<HIIfff")
+# Seconds a reading may be timestamped ahead of the server's clock.
+# A reading from the future would stay the latest one and make every real reading after it look out of order.
+MAX_CLOCK_SKEW = 5 * 60
+
+# Largest sensor id (uint16) and sequence (uint32) accepted in either format
+MAX_SENSOR_ID = 2**16 - 1
+MAX_SEQUENCE = 2**32 - 1
+
+ingest_key = web.AppKey("ingest", IngestQueue)
+stream_key = web.AppKey("stream", stream.StreamHub)
+
+
+def _authorized(request):
     """
-    Creates a connection to the raspberry pi which is collecting data to a database.
-    Handles formatting and checking wheter there is data to save.
+    Checks that the request carries the shared API key.
     """
-    auth_header = request.headers.get('Authorization')
-    if auth_header != f"Bearer {config.API_KEY}":
-        return web.json_response({"error": "Unauthorized"}, status=401)
+    return request.headers.get('Authorization') == f"Bearer {config.API_KEY}"
+
+
+def _parse_timestamp(value):
+    """
+    Converts a client timestamp (unix epoch or ISO 8601 string) into the
+    UTC "YYYY-MM-DD HH:MM:SS" format the database uses.
+    Naive ISO strings are considered to be in UTC.
+    Raises ValueError if the timestamp is more than MAX_CLOCK_SKEW seconds in the future.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        dt = datetime.fromtimestamp(value, tz=timezone.utc)
+    elif isinstance(value, str):
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        raise ValueError("Invalid timestamp")
+    if dt > datetime.now(timezone.utc) + timedelta(seconds=MAX_CLOCK_SKEW):
+        raise ValueError("Timestamp is in the future")
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-    try:
-        data = await request.json()
-    except json.JSONDecodeError:
-        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+def _parse_reading(data):
+    """
+    Validates one reading from a client.
+    Returns a tuple of (Reading, None) on success or (None, error message) on failure.
+    """
+    if not isinstance(data, dict):
+        return None, "Reading must be a JSON object"
 
     temp = data.get('temperature')
     humidity = data.get('humidity')
     co2 = data.get('co2')
+    sensor_id = data.get('sensor_id')
+    sequence = data.get('sequence')
 
     if temp is None or humidity is None or co2 is None:
-        return web.json_response({"error": "Missing temperature, humidity, or CO2"}, status=400)
+        return None, "Missing temperature, humidity, or CO2"
 
     try:
         temp = float(temp)
         humidity = float(humidity)
         co2 = float(co2)
-    except ValueError:
-        return web.json_response({"error": "Invalid numeric values"}, status=400)
+    except (TypeError, ValueError):
+        return None, "Invalid numeric values"
+    # float() and the json module both accept NaN and Infinity, which would end up as NULL in the database
+    if not (math.isfinite(co2) and math.isfinite(temp) and math.isfinite(humidity)):
+        return None, "Invalid numeric values"
+    # Same ranges as in the binary records, too large numbers would fail the whole write of the batch
+    if sensor_id is not None and (not isinstance(sensor_id, int) or isinstance(sensor_id, bool)
+                                  or not 0 <= sensor_id <= MAX_SENSOR_ID):
+        return None, "Invalid sensor_id"
+    if sequence is not None and (not isinstance(sequence, int) or isinstance(sequence, bool)
+                                 or not 0 <= sequence <= MAX_SEQUENCE):
+        return None, "Invalid sequence"
+
+    if data.get('timestamp') is not None:
+        try:
+            timestamp = _parse_timestamp(data['timestamp'])
+        except (OverflowError, OSError, ValueError):
+            return None, "Invalid timestamp"
+    elif sequence is not None:
+        # A resent reading is recognized by its sequence and timestamp, the time of arrival would differ every time
+        return None, "A reading with a sequence needs a timestamp"
+    else:
+        # Stamped on arrival, the queue may hold the reading for a moment before it's saved
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    return Reading(timestamp, co2, temp, humidity, sensor_id, sequence), None
+
+
+def _unpack_reading(sensor_id, sequence, epoch, co2, temp, humidity):
+    """
+    Validates one binary record, returns the same as _parse_reading.
+    """
+    if not (math.isfinite(co2) and math.isfinite(temp) and math.isfinite(humidity)):
+        return None, "Invalid numeric values"
+    if epoch > time.time() + MAX_CLOCK_SKEW:
+        return None, "Invalid timestamp"
+    if sequence and not epoch:
+        return None, "A reading with a sequence needs a timestamp"
+    # Formatted straight from the epoch, which is far faster than going through datetime
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch or None))
+    return Reading(timestamp, co2, temp, humidity, sensor_id, sequence or None), None
+
+
+def parse_binary(body):
+    """
+    Decodes a binary batch into a list of (Reading, None) or (None, error message).
+    Raises ValueError if the body isn't made of whole records.
+    """
+    if len(body) % BINARY_RECORD.size:
+        raise ValueError(f"Body must consist of {BINARY_RECORD.size} byte records")
+    return [_unpack_reading(*record) for record in BINARY_RECORD.iter_unpack(body)]
+
+
+async def upload_sensor(request):
+    """
+    Creates a connection to the raspberry pi which is collecting data to a database.
+    Handles formatting and checking wheter there is data to save.
+    """
+    if not _authorized(request):
+        return web.json_response({"error": "Unauthorized"}, status=401)
+
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+    reading, err = _parse_reading(data)
+    if err:
+        return web.json_response({"error": err}, status=400)
 
-    save_climate_data(co2, temp, humidity)  # HUOM: päivitä myös tämä funktio!
-    print(f"Sensor data received: Temp={temp}, Humidity={humidity}, CO2={co2}")
+    if not request.app[ingest_key].put([reading]):
+        return _busy()
+    print(f"Sensor data received: Temp={reading.temperature}, Humidity={reading.humidity}, CO2={reading.co2}")
     return web.json_response({"status": "Sensor data received"})
 
 
+async def upload_sensor_batch(request):
+    """
+    Receives a JSON array of readings, e.g. from a sensor catching up after an outage.
+    Each reading may include its own "timestamp" and a "sensor_id" and "sequence" pair,
+    which makes resending a reading (e.g. after a timeout) safe. A reading with a sequence must have a timestamp.
+    The readings of every sensor end up in the same series, see db_utils.Reading.
+    Instead of JSON the batch can be sent as binary records (see BINARY_CONTENT_TYPE).
+    All valid readings are queued together and a status is returned for every item.
+    """
+    if not _authorized(request):
+        return web.json_response({"error": "Unauthorized"}, status=401)
+
+    if request.content_type == BINARY_CONTENT_TYPE:
+        body = await request.read()
+        if len(body) > MAX_BATCH_SIZE * BINARY_RECORD.size:
+            return web.json_response({"error": f"Too many readings, max {MAX_BATCH_SIZE}"}, status=413)
+        try:
+            parsed = parse_binary(body)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+    else:
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+
+        if not isinstance(data, list):
+            return web.json_response({"error": "Expected a list of readings"}, status=400)
+        if len(data) > MAX_BATCH_SIZE:
+            return web.json_response({"error": f"Too many readings, max {MAX_BATCH_SIZE}"}, status=413)
+        parsed = [_parse_reading(item) for item in data]
+
+    results = []
+    readings = []
+    for reading, err in parsed:
+        if err:
+            results.append({"status": "error", "error": err})
+        else:
+            results.append({"status": "queued"})
+            readings.append(reading)
+
+    if readings and not request.app[ingest_key].put(readings):
+        return _busy()
+
+    print(f"Sensor batch received: {len(readings)}/{len(parsed)} readings queued")
+    return web.json_response({"queued": len(readings), "results": results})
+
+
+async def climate_stream(request):
+    """
+    Streams the climate readings as Server-Sent Events as they arrive,
+    starting with the latest known reading.
+    """
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+                                           "Cache-Control": "no-cache",
+                                           # Keeps a reverse proxy from buffering the events
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    hub = request.app[stream_key]
+    q = hub.subscribe()
+    try:
+        await response.write(f"retry: {stream.RETRY}\n\n".encode())
+        latest = snapshot.latest()
+        if latest:
+            epoch, co2, temp, humidity = latest
+            await response.write(stream.encode(Reading(snapshot.to_timestamp(epoch), co2, temp, humidity)))
+        while True:
+            try:
+                event = await asyncio.wait_for(q.get(), stream.HEARTBEAT)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+            if event is None:
+                break
+            await response.write(event)
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.unsubscribe(q)
+    return response
+
+
+async def get_metrics(request):
+    """
+    Metrics of the bot and the web app for Prometheus.
+    """
+    return web.Response(text=metrics.render(metrics.collect()), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+@web.middleware
+async def timing_middleware(request, handler):
+    """
+    Counts and times the requests of every route except the long-lived /stream.
+    """
+    route = request.match_info.route.resource
+    path = route.canonical if route is not None else "unmatched"
+    if path == "/stream":
+        return await handler(request)
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.registry.inc("kiltisbot_http_requests_total", (("route", path), ("status", str(status))))
+        metrics.registry.observe("kiltisbot_http_request_duration_seconds", (("route", path),),
+                                 time.perf_counter() - start_time)
+
+
+def _busy():
+    """
+    Response for when the database writer can't keep up and the ingest queue is full.
+    """
+    return web.json_response({"error": "Ingest queue full, try again later"}, status=503,
+                             headers={"Retry-After": "5"})
+
+
+async def _start_ingest(app):
+    writer = None
+    try:
+        writer = snapshot.SnapshotWriter()
+        since = datetime.now(timezone.utc) - timedelta(seconds=snapshot.HISTORY_SECONDS)
+        writer.publish(get_climate_since(since.strftime("%Y-%m-%d %H:%M:%S")))
+        app[ingest_key].listeners.append(writer.publish)
+    except Exception as e:
+        # The bot reads the database instead
+        logger.warning("Could not share climate data in memory: %s", e)
+
+    estimator = occupancy.OccupancyEstimator.load()
+
+    def estimate(readings):
+        people = estimator.update(readings)
+        if writer is not None:
+            writer.publish_people(people)
+
+    app[ingest_key].listeners.append(estimate)
+
+    # Only the readings that were actually saved go to the live clients, not the resent duplicates
+    loop = asyncio.get_running_loop()
+    hub = app[stream_key]
+    app[ingest_key].listeners.append(lambda readings: loop.call_soon_threadsafe(hub.publish, readings))
+    app[ingest_key].start()
+
+
+async def _close_streams(app):
+    # Lets the open /stream responses finish so the shutdown doesn't wait for them
+    app[stream_key].close()
+
+
+async def _stop_ingest(app):
+    # Flushes the pending readings before the web app shuts down
+    await asyncio.to_thread(app[ingest_key].stop)
+
+
 def create_web_app():
     """
     Create a web app, through which the climate data is handled.
     """
-    app = web.Application()
-    app.add_routes([web.post('/upload_sensor', upload_sensor)])
+    app = web.Application(middlewares=[timing_middleware])
+    app[ingest_key] = IngestQueue()
+    app[stream_key] = stream.StreamHub()
+    app.on_startup.append(_start_ingest)
+    app.on_shutdown.append(_close_streams)
+    app.on_cleanup.append(_stop_ingest)
+    app.add_routes([web.post('/upload_sensor', upload_sensor),
+                    web.post('/upload_sensor/batch', upload_sensor_batch),
+                    web.get('/stream', climate_stream),
+                    web.get('/metrics', get_metrics)])
     return app
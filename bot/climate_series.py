@@ -0,0 +1,89 @@
+import itertools
+
+import numpy as np
+
+from db_utils import climatedb, _init_db, _close_db
+import retention
+import rollups
+
+"""
+Loads climate data for plotting straight into NumPy arrays, without pandas.
+Rows are fetched in chunks into preallocated arrays and the TEXT timestamps
+are parsed by NumPy a whole chunk at a time instead of one by one in Python.
+Times are returned as UTC datetime64[s], matplotlib shows them in local time
+through the timezone of the axis formatter and locators.
+"""
+
+# Columns of a loaded series, the archive files have the sensor ids and sequences too
+COLUMNS = ("time", "co2", "temperature", "humidity")
+
+RAW_QUERY = """
+    SELECT timestamp, co2, temperature, humidity
+    FROM climate_data
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY timestamp ASC
+"""
+
+# Rows fetched from sqlite at a time
+CHUNK_SIZE = 10000
+
+
+def fetch_arrays(c, query, params, chunk_size=CHUNK_SIZE):
+    """
+    Runs a query returning (timestamp, co2, temperature, humidity) rows and
+    collects the result into a dict of arrays.
+    """
+    c.execute(query, params)
+    capacity = chunk_size
+    times = np.empty(capacity, dtype="datetime64[s]")
+    values = np.empty((capacity, 3), dtype=np.float32)
+    count = 0
+    while True:
+        rows = c.fetchmany(chunk_size)
+        if not rows:
+            break
+        n = len(rows)
+        if count + n > capacity:
+            capacity = max(capacity * 2, count + n)
+            times = np.resize(times, capacity)
+            values = np.resize(values, (capacity, 3))
+        # NumPy parses the "YYYY-MM-DD HH:MM:SS" strings of the whole chunk in one go
+        times[count:count + n] = np.array([row[0] for row in rows], dtype="datetime64[s]")
+        values[count:count + n] = np.fromiter(itertools.chain.from_iterable(row[1:] for row in rows),
+                                              dtype=np.float64, count=3 * n).reshape(n, 3)
+        count += n
+
+    return {
+        "time": times[:count],
+        "co2": values[:count, 0],
+        "temperature": values[:count, 1],
+        "humidity": values[:count, 2],
+    }
+
+
+def load_climate(t_start, t_end, max_points):
+    """
+    Returns the climate data between two UTC datetimes as a dict of arrays sorted by time.
+    Long time ranges are read from the rollups and archived raw data from the archive files.
+    """
+    t_start_str = t_start.strftime("%Y-%m-%d %H:%M:%S")
+    t_end_str = t_end.strftime("%Y-%m-%d %H:%M:%S")
+
+    conn, c = _init_db(climatedb)
+    try:
+        resolution = rollups.pick_resolution(c, t_start, t_end, max_points)
+        # Only the hour and day rollups are kept for archived data
+        archived = t_start < retention.cutoff()
+        if resolution == 60 and archived:
+            resolution = None
+        if resolution is not None:
+            return fetch_arrays(c, rollups.ROLLUP_QUERY, (resolution, t_start_str, t_end_str))
+        series = fetch_arrays(c, RAW_QUERY, (t_start_str, t_end_str))
+    finally:
+        _close_db(conn, c)
+
+    if archived:
+        old = retention.load_archive(t_start, t_end)
+        series = {column: np.concatenate([old[column], series[column]]).astype(series[column].dtype)
+                  for column in COLUMNS}
+    return series
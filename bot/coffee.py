@@ -1,11 +1,15 @@
 import time
 import io
 import math
-from PIL import Image
+from typing import TYPE_CHECKING
 import httpx
 from telegram import Update
 from telegram.ext import ContextTypes
 from logger import logger
+import metrics
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 # Variables for saving analysis and timestamp globally (could also be in confi.py)
 _last_analysis = None
@@ -25,7 +29,7 @@ async def get_coffee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text(f"Sending photo failed: {e}")
 
 
-def analyze_coffee(image: Image.Image) -> int:
+def analyze_coffee(image: "Image.Image") -> int:
     """
     Here's a function to analyze the coffeepot picture.
     Returns the result of the analysis, like the proportion of dark pixels.
@@ -57,13 +61,16 @@ async def get_coffee_analysis():
 
     # Requesting a new pic from the raspberry at the guildroom
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post("http://localhost:6000")
-            resp.raise_for_status()
-            content = resp.content
+        with metrics.timed_http("coffee_camera"):
+            async with httpx.AsyncClient() as client:
+                resp = await client.post("http://localhost:6000")
+                resp.raise_for_status()
+                content = resp.content
     except httpx.RequestError as e:
         raise RuntimeError(f"Could not fetch coffee image: {e}")
 
+    from PIL import Image
+
     image = Image.open(io.BytesIO(content))
     image.save("kuva.png")
     # Analyze the picture
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import threading
+
+"""
+Long-lived sqlite connections shared by every database helper.
+Opening a new connection for every command means paying for the connect and a cold page cache every time,
+so instead each thread of each process keeps one connection per database file open for its whole lifetime.
+Connections are never shared between threads or between the bot and web processes.
+"""
+
+# Applied to every new connection.
+# WAL lets the bot read while the web process writes climate data and
+# synchronous=NORMAL is crash-safe in WAL mode while syncing much less often.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # 8 MB page cache
+    "PRAGMA mmap_size=67108864",  # 64 MB
+)
+
+# How many prepared statements each connection keeps cached
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def _connections():
+    """
+    Returns the connections of the current thread.
+    A forked process starts with an empty set instead of reusing the parent's connections.
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def get_connection(path):
+    """
+    Returns the connection of this thread to the database at path, opening it on first use.
+    """
+    connections = _connections()
+    key = os.path.abspath(path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        connections[key] = conn
+    return conn
+
+
+def close_all():
+    """
+    Closes every connection opened by the current thread.
+    """
+    connections = _connections()
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
@@ -1,36 +1,192 @@
+import os
 import sqlite3
+from collections import namedtuple
+
+from connections import get_connection
+from metrics import TimedCursor
 
 
 def _init_db(path):
     """
-    Create a connection to a desired database
+    Get the shared connection to a desired database and a new cursor for it.
+    Release them with _close_db instead of closing the connection.
     """
-    conn = sqlite3.connect(path)
-    c = conn.cursor()
+    conn = get_connection(path)
+    c = conn.cursor(TimedCursor)
+    c.database = os.path.basename(path)
     return conn, c
 
 
+def _close_db(conn, c):
+    """
+    Rolls back anything left uncommitted and closes the cursor.
+    The connection itself stays open for the next command.
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    c.close()
+
+
 #  Databaseinformation for creating them
 quotedb = "quote.db"
 init_quote_db = "CREATE TABLE IF NOT EXISTS quotes (quote_text TEXT, tags TEXT, message_id INT, chat_id INT, said_by TEXT, added_by TEXT, said_date TEXT, added_date TEXT, UNIQUE(message_id, chat_id))"
+# Full-text index of the quotes, kept in sync with the quotes table by triggers.
+# It refers to the quotes by rowid, so quote.db must not be vacuumed without rebuilding it:
+# INSERT INTO quotes_fts(quotes_fts) VALUES ('rebuild')
+# Diacritics are kept, ä and a are different letters in Finnish.
+# The prefix indexes make searching for the first letters of a word fast.
+init_quote_search = """
+CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5(
+    quote_text, said_by, tags, content='quotes', content_rowid='rowid', tokenize='unicode61 remove_diacritics 0',
+    prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS quotes_fts_insert AFTER INSERT ON quotes BEGIN
+    INSERT INTO quotes_fts (rowid, quote_text, said_by, tags) VALUES (new.rowid, new.quote_text, new.said_by, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS quotes_fts_delete AFTER DELETE ON quotes BEGIN
+    INSERT INTO quotes_fts (quotes_fts, rowid, quote_text, said_by, tags)
+    VALUES ('delete', old.rowid, old.quote_text, old.said_by, old.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS quotes_fts_update AFTER UPDATE ON quotes BEGIN
+    INSERT INTO quotes_fts (quotes_fts, rowid, quote_text, said_by, tags)
+    VALUES ('delete', old.rowid, old.quote_text, old.said_by, old.tags);
+    INSERT INTO quotes_fts (rowid, quote_text, said_by, tags) VALUES (new.rowid, new.quote_text, new.said_by, new.tags);
+END
+"""
 jokedb = "joke.db"
 init_joke_db = "CREATE TABLE IF NOT EXISTS jokes (joke_text TEXT, tags TEXT, date_added INT)"
 climatedb = "climate.db"
 init_climate_db = "CREATE TABLE IF NOT EXISTS climate_data (id INTEGER PRIMARY KEY AUTOINCREMENT, co2 REAL, temperature REAL, humidity REAL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)"
+# Min/max/sum and count of the climate data per minute, hour and day (resolution in seconds, buckets in UTC).
+# Kept up to date by a trigger on every insert, so long time ranges never have to read the raw rows.
+# Readings with a missing value are left out, a single NULL would turn the min, max and sum of the bucket NULL for good.
+init_climate_rollup = """
+CREATE TABLE IF NOT EXISTS climate_rollup (
+    resolution INTEGER, bucket TEXT, count INTEGER,
+    co2_min REAL, co2_max REAL, co2_sum REAL,
+    temperature_min REAL, temperature_max REAL, temperature_sum REAL,
+    humidity_min REAL, humidity_max REAL, humidity_sum REAL,
+    PRIMARY KEY (resolution, bucket)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS climate_rollup_insert AFTER INSERT ON climate_data
+WHEN NEW.co2 IS NOT NULL AND NEW.temperature IS NOT NULL AND NEW.humidity IS NOT NULL
+BEGIN
+    INSERT INTO climate_rollup
+    SELECT column1, datetime(CAST(strftime('%s', NEW.timestamp) AS INTEGER) / column1 * column1, 'unixepoch'), 1,
+           NEW.co2, NEW.co2, NEW.co2,
+           NEW.temperature, NEW.temperature, NEW.temperature,
+           NEW.humidity, NEW.humidity, NEW.humidity
+    FROM (VALUES (60), (3600), (86400)) WHERE true
+    ON CONFLICT (resolution, bucket) DO UPDATE SET
+        count = count + 1,
+        co2_min = min(co2_min, excluded.co2_min), co2_max = max(co2_max, excluded.co2_max),
+        co2_sum = co2_sum + excluded.co2_sum,
+        temperature_min = min(temperature_min, excluded.temperature_min),
+        temperature_max = max(temperature_max, excluded.temperature_max),
+        temperature_sum = temperature_sum + excluded.temperature_sum,
+        humidity_min = min(humidity_min, excluded.humidity_min),
+        humidity_max = max(humidity_max, excluded.humidity_max),
+        humidity_sum = humidity_sum + excluded.humidity_sum;
+END
+"""
+# Rebuilds the rollups from the raw climate data.
+# Raw rows older than the retention period only exist in the archive (see retention.py),
+# so the buckets before the oldest raw row are kept as they are. The bucket the oldest row falls in
+# is only added if it's missing, the rows before it in the same bucket may have been archived.
+backfill_climate_rollup = """
+DELETE FROM climate_rollup WHERE bucket >= (SELECT MIN(timestamp) FROM climate_data);
+INSERT OR IGNORE INTO climate_rollup
+SELECT column1, datetime(CAST(strftime('%s', timestamp) AS INTEGER) / column1 * column1, 'unixepoch') AS bucket,
+       COUNT(*),
+       MIN(co2), MAX(co2), SUM(co2),
+       MIN(temperature), MAX(temperature), SUM(temperature),
+       MIN(humidity), MAX(humidity), SUM(humidity)
+FROM climate_data, (VALUES (60), (3600), (86400))
+WHERE co2 IS NOT NULL AND temperature IS NOT NULL AND humidity IS NOT NULL
+GROUP BY column1, bucket
+"""
+# State and calibrated parameters of the occupancy estimator (see occupancy.py), a single row each
+init_occupancy = """
+CREATE TABLE IF NOT EXISTS occupancy_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1), timestamp TEXT, co2 REAL, people REAL, p00 REAL, p01 REAL, p11 REAL
+);
+CREATE TABLE IF NOT EXISTS occupancy_params (
+    id INTEGER PRIMARY KEY CHECK (id = 1), air_exchange REAL, generation REAL, outdoor_co2 REAL
+)
+"""
 songdb = "song.db"
 init_song_db = "CREATE TABLE IF NOT EXISTS songs (song_name TEXT, song_melody TEXT, song_writers TEXT, song_composers TEXT, song_number TEXT, page_number TEXT, song_lyrics TEXT)"
 
 
+# One sensor reading. A timestamp of None lets the database stamp the row on insert.
+# sensor_id is None for readings of the original sensor. It only tells apart the sequence numbers of the sensors:
+# the rollups, the snapshot, the occupancy estimate, /stream and /plot treat all readings as one series of the room,
+# so only one sensor per room is supported.
+# sequence is a number the sensor gives every reading, so a resent reading is saved only once.
+# It's unique together with the timestamp, so a sensor that lost its counter and starts again from 1
+# doesn't have its new readings ignored as duplicates of the old ones.
+Reading = namedtuple("Reading", "timestamp co2 temperature humidity sensor_id sequence", defaults=(None, None))
+
+
 def save_climate_data(co2, temperature, humidity):
     """
     Passively saving climate data from the guildroom through a raspberry pi into a database.
     """
+    return save_climate_batch([Reading(None, co2, temperature, humidity)])
+
+
+def get_climate_since(timestamp):
+    """
+    Returns the Readings saved after a UTC timestamp string, oldest first.
+    """
     conn, c = _init_db(climatedb)
     try:
-        c.execute("INSERT INTO climate_data (co2, temperature, humidity) VALUES (?, ?, ?)",
-                  (co2, temperature, humidity))
+        rows = c.execute("""
+                         SELECT timestamp, co2, temperature, humidity, sensor_id, sequence
+                         FROM climate_data
+                         WHERE timestamp > ?
+                         ORDER BY timestamp ASC
+                         """,
+                         (timestamp,)).fetchall()
+        return [Reading(*row) for row in rows]
+    finally:
+        _close_db(conn, c)
+
+
+def save_climate_batch(readings):
+    """
+    Saves a list of Readings with a single connection and a single transaction,
+    so a whole batch costs one commit instead of one per row.
+    Readings with a (sensor_id, sequence, timestamp) that has already been saved are skipped.
+    Returns the list of Readings actually inserted or None if the batch couldn't be saved.
+    Raises sqlite3.OperationalError if another connection kept the database locked past the busy timeout,
+    the same batch can be saved again later.
+    """
+    conn, c = _init_db(climatedb)
+    try:
+        inserted = []
+        for reading in readings:
+            c.execute("""
+                      INSERT OR IGNORE INTO climate_data (timestamp, co2, temperature, humidity, sensor_id, sequence)
+                      VALUES (COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?, ?)
+                      """,
+                      reading)
+            if c.rowcount:
+                inserted.append(reading)
         conn.commit()
+        return inserted
     except Exception as e:
+        conn.rollback()
+        if _locked(e):
+            raise
         print("Failed to save climate data:", e)
+        return None
     finally:
-        conn.close()
+        _close_db(conn, c)
+
+
+def _locked(error):
+    """
+    Whether an error only means another connection was holding a lock at the time.
+    """
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
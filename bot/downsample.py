@@ -0,0 +1,42 @@
+import numpy as np
+
+"""
+Downsampling of time series for plotting with Largest-Triangle-Three-Buckets
+(Sveinn Steinarsson, 2013). Keeps the visual shape of a series, peaks included,
+with a fixed amount of points however long the series is.
+"""
+
+
+def lttb(x, y, n_out):
+    """
+    Returns the indices of the n_out points of (x, y) chosen by LTTB.
+    x must be sorted and numeric. Short series are returned whole.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # First and last points are always kept, the rest are split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # Average point of every bucket, used as the third corner of the triangles
+    counts = np.diff(edges)
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Twice the triangle areas between the previous pick, each candidate and the next bucket's average
+        areas = np.abs((x[a] - avg_x[i + 1]) * (y[start:end] - y[a])
+                       - (x[a] - x[start:end]) * (avg_y[i + 1] - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
@@ -0,0 +1,139 @@
+import queue
+import sqlite3
+import threading
+import time
+
+from db_utils import save_climate_batch
+from logger import logger
+
+"""
+Write-behind queue for the climate data coming in through the web app.
+The aiohttp handlers only put readings into the queue and a dedicated writer thread
+saves them to the database in groups, so slow disk I/O never blocks the event loop.
+"""
+
+# Max amount of readings waiting to be written before uploads are refused
+QUEUE_SIZE = 5000
+# Readings are written when this many seconds have passed since the first pending reading...
+FLUSH_INTERVAL = 0.5
+# ...or when this many readings are pending, whichever comes first
+FLUSH_ROWS = 500
+# Seconds to wait before saving again when the database is locked, doubled after every try up to MAX_RETRY_DELAY.
+# The readings were already acknowledged to the clients, so they are kept until the lock is gone
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+
+class IngestQueue:
+    """
+    Bounded queue of Readings drained by a single writer thread.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE, flush_interval=FLUSH_INTERVAL, flush_rows=FLUSH_ROWS):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._queue = queue.Queue(maxsize)
+        # Called from the writer thread with every batch of readings saved to the database,
+        # leaving out the ones that were already there
+        self.listeners = []
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the writer thread.
+        """
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="climate-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes everything still in the queue and stops the writer thread.
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def put(self, readings):
+        """
+        Queues a list of readings without blocking.
+        Either all of the readings are queued or none of them.
+        Returns False if the queue is too full (or closed) to take them.
+        """
+        if self._stopping.is_set() or self._queue.qsize() + len(readings) > self.maxsize:
+            return False
+        # Only the event loop puts readings into the queue, so the space checked above can't run out
+        for reading in readings:
+            self._queue.put_nowait(reading)
+        return True
+
+    def _run(self):
+        """
+        Group commits pending readings every flush_interval seconds or flush_rows readings.
+        """
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            except Exception:
+                # The thread must keep running, otherwise every upload after this is refused with a full queue
+                logger.exception("Climate writer failed, dropped %d readings", len(batch))
+
+    def _write(self, batch):
+        """
+        Saves a group of readings in one transaction.
+        If that fails, the readings are saved one at a time so one bad reading doesn't take the rest with it.
+        """
+        inserted = self._save(batch)
+        if inserted is None:
+            inserted = []
+            failed = 0
+            for reading in batch:
+                saved = self._save([reading])
+                if saved is None:
+                    failed += 1
+                else:
+                    inserted.extend(saved)
+            if failed:
+                logger.error("Dropped %d of %d climate readings after a failed write", failed, len(batch))
+        if not inserted:
+            return
+        for listener in self.listeners:
+            try:
+                listener(inserted)
+            except Exception as e:
+                logger.error("Climate data listener failed: %s", e)
+
+    def _save(self, readings):
+        """
+        Saves readings, waiting and trying again for as long as the database is locked.
+        Returns the same as save_climate_batch.
+        """
+        delay = RETRY_DELAY
+        while True:
+            try:
+                return save_climate_batch(readings)
+            except sqlite3.OperationalError as e:
+                logger.warning("Climate database locked, saving %d readings again in %d s: %s",
+                               len(readings), delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
@@ -1,13 +1,16 @@
 import random
-import sqlite3
 import logging
 
 from telegram import Update
 from telegram.ext import ContextTypes
 
 import config
-from db_utils import jokedb, _init_db
+from db_utils import jokedb, _init_db, _close_db
 from logger import logger
+from query_cache import QueryCache, fold_ascii
+
+# search words: rowids of the matching jokes
+_search_cache = QueryCache("joke")
 
 
 def _get_message_args(string):
@@ -53,18 +56,19 @@ async def add_joke(update: Update, context: ContextTypes.DEFAULT_TYPE):
         c.execute("INSERT INTO jokes VALUES (?, ?, ?)",
                   (joke, tags, date_added))
         conn.commit()
+        _search_cache.invalidate()
         await update.message.reply_text("✅ Joke added ✅")
     except Exception as e:
         await update.message.reply_text(f"⚠️ Error adding joke ⚠️"
                                         f"\n{e}")
     finally:
-        conn.close()
+        _close_db(conn, c)
 
 
-def _search_joke(args):
+def _search_candidates(args):
     """
-    Fetches a random joke based on arguments, which are matched
-    with text of joke or tags of a joke
+    Returns the rowids of the jokes whose text or tags contain any of the arguments.
+    A joke is listed once for every match, so the ones matching more are more likely to be picked.
     """
     def like(string):
         return "%{}%".format(string)
@@ -74,25 +78,47 @@ def _search_joke(args):
     try:
         for arg in args:
             ret = c.execute("""
-                             SELECT joke_text
+                             SELECT rowid
                              FROM jokes
                              WHERE joke_text LIKE :arg
                              """,
                              {"arg": like(arg)}
                              ).fetchall()
             ret += c.execute("""
-                             SELECT joke_text
+                             SELECT rowid
                              FROM jokes
                              WHERE tags LIKE :arg
                              """,
                              {"arg": like(arg)}
                              ).fetchall()
-            results.extend(ret)
+            results.extend(row[0] for row in ret)
     finally:
-        conn.close()
+        _close_db(conn, c)
+    return results
+
+
+def _search_joke(args):
+    """
+    Fetches a random joke based on arguments, which are matched
+    with text of joke or tags of a joke
+    """
+    # LIKE ignores the case of ASCII letters and the matches of every argument are added up in any order
+    key = tuple(sorted(fold_ascii(arg) for arg in args))
+    candidates = _search_cache.get(key, lambda: _search_candidates(args))
+    if not candidates:
+        return None
 
-    joke = random.choice(results)[0] if results else None
-    return joke
+    conn, c = _init_db(jokedb)
+    try:
+        ret = c.execute("""
+                        SELECT joke_text
+                        FROM jokes
+                        WHERE rowid = ?
+                        """,
+                        (random.choice(candidates),)).fetchone()
+    finally:
+        _close_db(conn, c)
+    return ret[0] if ret else None
 
 
 def _random_joke():
@@ -108,7 +134,7 @@ def _random_joke():
                         ORDER BY RANDOM() LIMIT 1
                         """).fetchone()
     finally:
-        conn.close()
+        _close_db(conn, c)
     return ret[0] if ret else None
 
 
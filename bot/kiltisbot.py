@@ -10,48 +10,43 @@ email: kuusinen.aaro@gmail.com / okkixi@gmail.com
 """
 
 import logging
-import sqlite3
-import requests
-import os
-import spotipy
 import html
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
-from spotipy.oauth2 import SpotifyOAuth
-from aiohttp import web
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
 from multiprocessing import Process
 
 import config
-from db_utils import quotedb, init_quote_db, jokedb, init_joke_db, climatedb, init_climate_db, songdb, init_song_db
+from migrations import migrate_all
 import coffee
 from joke import get_joke, add_joke
-from quote import list_quotes, add_quote, delete_quote, get_quote
+from quote import list_quotes, list_quotes_page, add_quote, delete_quote, get_quote, LIST_CALLBACK
 from climate import guild_data, get_plot, people_count
+import plot_worker
 from logger import logger
-from climate_api import create_web_app
+import metrics
 from trivia import trivia
 from virpi import get_song, add_song, delete_song
 
 LOCAL_TZ = ZoneInfo("Europe/Helsinki")
 
+# Heavy libraries (spotipy, requests, aiohttp, PIL...) are imported only in the functions using them.
+# Most commands never need them, so the bot starts and answers much faster without.
 
-def _create_db(database, init_query):
-    print("Initializing database...")
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
+
+def _migrate_databases():
+    """
+    Creates the databases or updates their schema before the bot or the web app use them.
+    """
+    print("Initializing databases...")
     try:
-        c.executescript(init_query)
-        conn.commit()
-        conn.close()
+        migrate_all()
         print("Success.")
     except Exception as e:
-        print(f"Failed to initialize database: {e}")
-        conn.close()
+        print(f"Failed to initialize databases: {e}")
         quit()
-    else:
-        conn.close()
 
 
 """
@@ -87,7 +82,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                  "<b>Example:</b> /virpi hyvät ystävät\n\n"
                  ""
                  "/plot\n"
-                 "Draws a plot from the climate data <i>(last 24h)</i>\n"
+                 "Draws a plot from the climate data <i>(last 24h by default)</i>\n"
+                 "<b>Example:</b> /plot 7d <i>or</i> /plot 2025-01-01 2025-02-01\n"
                  "<b>CO2:</b> Solid line every <i>200ppm</i> and dashed every <i>100ppm</i>\n"
                  "<b>Temp:</b> Solid line every <i>1°C</i> and dashed every <i>0,5°C</i>\n"
                  "<b>Humid:</b> Solid line every <i>5%</i> and dashed every <i>2,5%</i>\n\n"
@@ -99,7 +95,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                  "/stalk\n"
                  "Get an estimated latest occupancy of the guildroom. "
                  "Based on the climate data\n"
-                 "<i>(Currently a simple linear model based on co2 levels)</i>\n\n"
+                 "<i>(A model of how people raise the co2 levels, updated with every reading)</i>\n\n"
                  ""
                  "/fact\n"
                  "Get a random useless fact.\n\n"
@@ -152,6 +148,9 @@ async def music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     Fetches the current song playing on the guild spotify-account.
     AKA what's playing in the guildroom
     """
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
     try:
         # Create auth_manager without cache (or use just refresh_token)
         auth_manager = SpotifyOAuth(
@@ -163,7 +162,8 @@ async def music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
         # 🔁 Update access token using refresh token
-        token_info = auth_manager.refresh_access_token(config.REFRESH_TOKEN)
+        with metrics.timed_http("spotify"):
+            token_info = auth_manager.refresh_access_token(config.REFRESH_TOKEN)
         access_token = token_info.get("access_token")
 
         if not access_token:
@@ -172,7 +172,8 @@ async def music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
         # 🎵 Retreive information about the current song
         spotify = spotipy.Spotify(auth=access_token)
-        track = spotify.current_user_playing_track()
+        with metrics.timed_http("spotify"):
+            track = spotify.current_user_playing_track()
 
         if track and track.get("item"):
             name = track["item"].get("name", "Unknown title")
@@ -194,8 +195,11 @@ async def fun_fact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     Retrieves a fun/useless fact from an api for them.
     Can also be changed to other facts.
     """
+    import requests
+
     try:
-        response = requests.get("https://uselessfacts.jsph.pl/api/v2/facts/random?language=en")
+        with metrics.timed_http("uselessfacts"):
+            response = requests.get("https://uselessfacts.jsph.pl/api/v2/facts/random?language=en")
         response.raise_for_status()
         data = response.json()
         fact = data.get("text", "🛑 Couldn't find a fact right now 🛑")
@@ -273,8 +277,11 @@ async def events(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'singleEvents': 'true'
     }
 
+    import requests
+
     try:
-        resp = requests.get(url, params=params)
+        with metrics.timed_http("google_calendar"):
+            resp = requests.get(url, params=params)
         resp.raise_for_status()
         items = resp.json().get("items", [])
 
@@ -294,7 +301,7 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Error handling and logging.
     """
-    logger.warning('Update "%s" caused error "%s"' % (update, error))
+    logger.error('Update "%s" caused error "%s"', update, context.error, exc_info=context.error)
 
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -304,56 +311,100 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     print(update)
 
 
-def start_bot():
-    # Create databases if they don't already exist
-    if not os.path.isfile(quotedb):
-        _create_db(quotedb, init_quote_db)
-    if not os.path.isfile(jokedb):
-        _create_db(jokedb, init_joke_db)
-    if not os.path.isfile(climatedb):
-        _create_db(climatedb, init_climate_db)
-    if not os.path.isfile(songdb):
-        _create_db(songdb, init_song_db)
+class TimedRequest(HTTPXRequest):
+    """
+    Times the calls to the Telegram Bot API, except for the long polling of updates.
+    """
+
+    async def do_request(self, *args, **kwargs):
+        with metrics.timed_http("telegram"):
+            return await super().do_request(*args, **kwargs)
+
+
+def _command(name, callback, block=True):
+    """
+    CommandHandler that counts and times its command for /metrics.
+    The updates are handled one at a time, block=False lets the next ones through
+    while a slow command is still running.
+    """
+    return CommandHandler(name, metrics.timed_command(name, callback), block=block)
+
 
+def _button(prefix, callback):
+    """
+    CallbackQueryHandler for the inline buttons whose data starts with prefix,
+    counted and timed for /metrics like a command named after the prefix.
+    """
+    return CallbackQueryHandler(metrics.timed_command(f"{prefix}_button", callback), pattern=f"^{prefix}:")
+
+
+def build_application(token=None, base_url=None):
+    """
+    Creates the Application with every command and button handler.
+    base_url points the bot to another Bot API server, e.g. the fake one of benchmarks/loadtest.py.
+    """
     # Create the Application and pass it your bot's token (found int the config-file)
-    application = Application.builder().token(config.kiltistoken).build()
+    builder = Application.builder().token(token or config.kiltistoken).request(TimedRequest())
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     # On different commands, answer in Telegram accordingly.
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("coffee", coffee.get_coffee))
-    application.add_handler(CommandHandler("events", events))
-    application.add_handler(CommandHandler("music", music))
-    application.add_handler(CommandHandler("plot", get_plot))
-    application.add_handler(CommandHandler("numbers", guild_data))
-    application.add_handler(CommandHandler("stalk", people_count))
-    application.add_handler(CommandHandler("fact", fun_fact))
-    application.add_handler(CommandHandler("trivia", trivia))
-    application.add_handler(CommandHandler("addquote", add_quote))
-    application.add_handler(CommandHandler("quote", get_quote))
-    application.add_handler(CommandHandler("listquotes", list_quotes))
-    application.add_handler(CommandHandler("deletequote", delete_quote))
-    application.add_handler(CommandHandler("addjoke", add_joke))
-    application.add_handler(CommandHandler("joke", get_joke))
-    application.add_handler(CommandHandler("virpi", get_song))
-    application.add_handler(CommandHandler("addsong", add_song))  # Hidden from other users
-    application.add_handler(CommandHandler("deletesong", delete_song))  # Hidden from other users
+    application.add_handler(_command("help", help_command))
+    application.add_handler(_command("coffee", coffee.get_coffee))
+    application.add_handler(_command("events", events))
+    application.add_handler(_command("music", music))
+    # Rendering takes a while, other commands shouldn't wait behind it
+    application.add_handler(_command("plot", get_plot, block=False))
+    application.add_handler(_command("numbers", guild_data))
+    application.add_handler(_command("stalk", people_count))
+    application.add_handler(_command("fact", fun_fact))
+    application.add_handler(_command("trivia", trivia))
+    application.add_handler(_command("addquote", add_quote))
+    application.add_handler(_command("quote", get_quote))
+    application.add_handler(_command("listquotes", list_quotes))
+    application.add_handler(_button(LIST_CALLBACK, list_quotes_page))
+    application.add_handler(_command("deletequote", delete_quote))
+    application.add_handler(_command("addjoke", add_joke))
+    application.add_handler(_command("joke", get_joke))
+    application.add_handler(_command("virpi", get_song))
+    application.add_handler(_command("addsong", add_song))  # Hidden from other users
+    application.add_handler(_command("deletesong", delete_song))  # Hidden from other users
 
     # For debugging
-    # application.add_handler(CommandHandler("echo", echo))
+    # application.add_handler(_command("echo", echo))
 
     # Add an error handler.
     application.add_error_handler(error)
+    return application
+
+
+def start_bot():
+    metrics.start("bot")
+    application = build_application()
+
+    # Start the plotting processes in advance
+    plot_worker.start()
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    plot_worker.stop()
 
 
 def run_web_app():
+    # Imported only in the web process, the bot process doesn't need aiohttp
+    from aiohttp import web
+    from climate_api import create_web_app
+
+    metrics.start("web")
     app = create_web_app()
     web.run_app(app, host='0.0.0.0', port=8000)
 
 
 def main() -> None:
+    # Databases are migrated once here, before the bot and web processes start using them
+    _migrate_databases()
+
     bot_process = Process(target=start_bot)
     bot_process.start()
     print(f"Bot process started with PID {bot_process.pid}")
@@ -0,0 +1,268 @@
+import atexit
+import bisect
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from logger import logger
+
+"""
+Performance metrics of the bot and the web app in the Prometheus text format.
+Each process counts into its own in-memory registry and saves it to METRICS_DIR/<process>.json
+every few seconds. The /metrics route of the web app adds up the files of the other processes
+and its own live registry, so one scrape covers both processes.
+"""
+
+METRICS_DIR = "metrics"
+# Seconds between saving the registry of a process
+FLUSH_INTERVAL = 10
+
+# Upper bounds (s) of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+METRICS = {
+    "kiltisbot_commands_total": ("counter", "Commands handled"),
+    "kiltisbot_command_errors_total": ("counter", "Commands that raised an exception"),
+    "kiltisbot_command_duration_seconds": ("histogram", "Time spent handling a command"),
+    "kiltisbot_http_requests_total": ("counter", "Requests handled by the web app"),
+    "kiltisbot_http_request_duration_seconds": ("histogram", "Time spent handling a web app request"),
+    "kiltisbot_sqlite_query_duration_seconds": ("histogram", "Time spent executing sqlite statements"),
+    "kiltisbot_sqlite_fetch_seconds_total": ("counter", "Time spent fetching rows from sqlite"),
+    "kiltisbot_outbound_http_duration_seconds": ("histogram", "Time spent on requests to other services"),
+    "kiltisbot_outbound_http_errors_total": ("counter", "Failed requests to other services"),
+    "kiltisbot_query_cache_hits_total": ("counter", "Searches answered from the query cache"),
+    "kiltisbot_query_cache_misses_total": ("counter", "Searches that had to query the database"),
+}
+
+
+class Registry:
+    """
+    Counters and histograms by name and labels. Thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count of every bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            values[bisect.bisect_left(BUCKETS, seconds)] += 1
+            values[-1] += seconds
+
+    def dump(self):
+        """
+        Returns the registry in a JSON friendly form.
+        """
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self.histograms.items()],
+            }
+
+    def merge(self, dump):
+        """
+        Adds up a dumped registry into this one.
+        """
+        for name, labels, value in dump["counters"]:
+            self.inc(name, tuple(map(tuple, labels)), value)
+        with self._lock:
+            for name, labels, values in dump["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                total = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+                for i, value in enumerate(values):
+                    total[i] += value
+
+
+registry = Registry()
+_process = None
+
+
+def _path(process):
+    return os.path.join(METRICS_DIR, f"{process}.json")
+
+
+def flush():
+    """
+    Saves the registry of this process for the /metrics route of the web app.
+    """
+    if _process is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _path(_process)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(registry.dump(), f)
+    os.replace(tmp_path, path)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError as e:
+            logger.warning("Could not save metrics: %s", e)
+
+
+def start(process, resume=False):
+    """
+    Starts saving the registry of this process under the given name, e.g. "bot".
+    If resume, counting continues from the registry saved under the name by an earlier process,
+    e.g. the plot worker this one replaced.
+    """
+    global _process
+    _process = process
+    if resume:
+        try:
+            with open(_path(process)) as f:
+                registry.merge(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not resume metrics from %s: %s", _path(process), e)
+    threading.Thread(target=_flush_periodically, name="metrics", daemon=True).start()
+    atexit.register(flush)
+
+
+def collect():
+    """
+    Returns the registry of this process added up with the saved registries of the others.
+    """
+    total = Registry()
+    total.merge(registry.dump())
+    if os.path.isdir(METRICS_DIR):
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith(".json") or filename == f"{_process}.json":
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    total.merge(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning("Could not read metrics from %s: %s", filename, e)
+    return total
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+def render(reg):
+    """
+    Formats a registry in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(reg.counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        for (metric, labels), values in sorted(reg.histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def timed_command(name, callback):
+    """
+    Wraps a command callback to count and time it.
+    Exceptions are counted and passed on to the error handler.
+    """
+    labels = (("command", name),)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        registry.inc("kiltisbot_commands_total", labels)
+        start_time = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            registry.inc("kiltisbot_command_errors_total", labels)
+            raise
+        finally:
+            registry.observe("kiltisbot_command_duration_seconds", labels, time.perf_counter() - start_time)
+
+    return wrapper
+
+
+@contextmanager
+def timed_http(service):
+    """
+    Times a request to another service, e.g. with timed_http("trivia"): requests.get(...)
+    """
+    labels = (("service", service),)
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc("kiltisbot_outbound_http_errors_total", labels)
+        raise
+    finally:
+        registry.observe("kiltisbot_outbound_http_duration_seconds", labels, time.perf_counter() - start_time)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor recording the time spent in sqlite per database, see db_utils._init_db.
+    """
+
+    database = ""
+
+    def _timed(self, method, *args):
+        start_time = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            registry.observe("kiltisbot_sqlite_query_duration_seconds", (("database", self.database),),
+                             time.perf_counter() - start_time)
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, *args)
+
+    def executescript(self, *args):
+        return self._timed(sqlite3.Cursor.executescript, *args)
+
+    def _fetched(self, method, *args):
+        start_time = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            registry.inc("kiltisbot_sqlite_fetch_seconds_total", (("database", self.database),),
+                         time.perf_counter() - start_time)
+
+    def fetchone(self):
+        return self._fetched(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetched(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetched(sqlite3.Cursor.fetchall)
@@ -0,0 +1,167 @@
+from db_utils import (_init_db, _close_db, quotedb, init_quote_db, init_quote_search, jokedb, init_joke_db,
+                      climatedb, init_climate_db, init_climate_rollup, backfill_climate_rollup, init_occupancy,
+                      songdb, init_song_db)
+
+"""
+Versioned schema migrations for the databases.
+The version of a database is kept in its PRAGMA user_version and every migration
+is run in its own transaction together with the version bump.
+A migration that can't be run on every database has a check in CHECKS, which stops the migration
+with instructions for the operator instead of changing data nobody would notice missing.
+Never edit a migration that has been released, add a new one to the end of the list instead.
+"""
+
+MIGRATIONS = {
+    quotedb: [
+        init_quote_db,
+        # 2: Indexes for searching quotes by chat and for listing a user's quotes
+        """
+        CREATE INDEX IF NOT EXISTS quotes_chat_id ON quotes (chat_id);
+        CREATE INDEX IF NOT EXISTS quotes_said_by ON quotes (said_by);
+        """,
+        # 3: Full-text search of the quotes, indexing the existing ones
+        init_quote_search + """;
+        INSERT INTO quotes_fts (quotes_fts) VALUES ('rebuild');
+        """,
+        # 4: Telegram user ids of the quotee and of the one who added the quote,
+        # so the quotes of a user are still theirs after a name change.
+        # The chat id of a private chat is the id of the user, so the quotes added there were added by that user
+        # and said by them too if the names match. The rest are claimed by name when another message of the quotee
+        # is quoted in the same chat.
+        # Setting the ids must not reindex the full-text search, so it's only updated when the indexed columns change.
+        """
+        DROP TRIGGER IF EXISTS quotes_fts_update;
+        CREATE TRIGGER quotes_fts_update AFTER UPDATE OF quote_text, said_by, tags ON quotes BEGIN
+            INSERT INTO quotes_fts (quotes_fts, rowid, quote_text, said_by, tags)
+            VALUES ('delete', old.rowid, old.quote_text, old.said_by, old.tags);
+            INSERT INTO quotes_fts (rowid, quote_text, said_by, tags) VALUES (new.rowid, new.quote_text, new.said_by, new.tags);
+        END;
+        ALTER TABLE quotes ADD COLUMN said_by_id INTEGER;
+        ALTER TABLE quotes ADD COLUMN added_by_id INTEGER;
+        UPDATE quotes SET added_by_id = chat_id WHERE chat_id > 0;
+        UPDATE quotes SET said_by_id = chat_id WHERE chat_id > 0 AND said_by = added_by;
+        CREATE INDEX IF NOT EXISTS quotes_said_by_id ON quotes (said_by_id, chat_id);
+        """,
+    ],
+    jokedb: [
+        init_joke_db,
+    ],
+    climatedb: [
+        init_climate_db,
+        # 2: Index for the latest reading and time range queries
+        """
+        CREATE INDEX IF NOT EXISTS climate_data_timestamp ON climate_data (timestamp);
+        """,
+        # 3: Minute, hour and day rollups filled from the existing history
+        init_climate_rollup + ";" + backfill_climate_rollup,
+        # 4: Occupancy estimator
+        init_occupancy,
+        # 5: Readings from more than one sensor
+        """
+        ALTER TABLE climate_data ADD COLUMN sensor_id INTEGER;
+        """,
+        # 6: Sequence numbers of the sensors, a resent reading is ignored (sensor_id NULL is the original sensor)
+        """
+        ALTER TABLE climate_data ADD COLUMN sequence INTEGER;
+        CREATE UNIQUE INDEX IF NOT EXISTS climate_data_sensor_sequence
+            ON climate_data (IFNULL(sensor_id, 0), sequence) WHERE sequence IS NOT NULL;
+        """,
+        # 7: The rollup trigger skips readings with missing values,
+        # the buckets a NULL already turned NULL are rebuilt from the raw rows still in the database
+        """
+        DROP TRIGGER IF EXISTS climate_rollup_insert;
+        """ + init_climate_rollup + """;
+        CREATE TEMP TABLE poisoned_rollup AS
+            SELECT resolution, bucket FROM climate_rollup
+            WHERE co2_sum IS NULL OR temperature_sum IS NULL OR humidity_sum IS NULL;
+        DELETE FROM climate_rollup WHERE (resolution, bucket) IN (SELECT resolution, bucket FROM poisoned_rollup);
+        INSERT INTO climate_rollup
+        SELECT column1, datetime(CAST(strftime('%s', timestamp) AS INTEGER) / column1 * column1, 'unixepoch') AS bucket,
+               COUNT(*),
+               MIN(co2), MAX(co2), SUM(co2),
+               MIN(temperature), MAX(temperature), SUM(temperature),
+               MIN(humidity), MAX(humidity), SUM(humidity)
+        FROM climate_data, (VALUES (60), (3600), (86400))
+        WHERE co2 IS NOT NULL AND temperature IS NOT NULL AND humidity IS NOT NULL
+        AND timestamp >= (SELECT MIN(bucket) FROM poisoned_rollup)
+        GROUP BY column1, bucket
+        HAVING (column1, bucket) IN (SELECT resolution, bucket FROM poisoned_rollup);
+        DROP TABLE poisoned_rollup;
+        """,
+        # 8: A sensor that lost its counter starts again from 1, the timestamp tells its new readings apart
+        # from the old ones with the same numbers
+        """
+        DROP INDEX IF EXISTS climate_data_sensor_sequence;
+        CREATE UNIQUE INDEX IF NOT EXISTS climate_data_sensor_sequence_time
+            ON climate_data (IFNULL(sensor_id, 0), sequence, timestamp) WHERE sequence IS NOT NULL;
+        """,
+    ],
+    songdb: [
+        init_song_db,
+        # 2: Song names are unique, exact copies of a song are dropped (see _check_song_names for the rest)
+        """
+        DELETE FROM songs WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM songs
+            GROUP BY song_name, song_melody, song_writers, song_composers, song_number, page_number, song_lyrics
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS songs_song_name ON songs (song_name);
+        """,
+    ],
+}
+
+
+def _check_song_names(c):
+    """
+    Songs with the same name but different details have to be merged by hand before the names can be unique.
+    """
+    names = [row[0] for row in c.execute("""
+                                         SELECT song_name
+                                         FROM (SELECT DISTINCT song_name, song_melody, song_writers, song_composers,
+                                                               song_number, page_number, song_lyrics
+                                               FROM songs
+                                               WHERE song_name IS NOT NULL)
+                                         GROUP BY song_name
+                                         HAVING COUNT(*) > 1
+                                         """).fetchall()]
+    if names:
+        raise RuntimeError(f"{songdb} has different songs with the same name, keep only one of each and restart: "
+                           + ", ".join(names))
+
+
+# (database, version): function called with a cursor before migrating the database to that version,
+# raises an exception if the migration can't be run
+CHECKS = {
+    (songdb, 2): _check_song_names,
+}
+
+
+def migrate(path, migrations):
+    """
+    Brings the database at path up to date by running the migrations it hasn't had yet.
+    Returns the resulting schema version.
+    """
+    conn, c = _init_db(path)
+    try:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(migrations[version:], start=version + 1):
+            print(f"Migrating {path} to version {number}...")
+            check = CHECKS.get((path, number))
+            if check:
+                check(c)
+            c.executescript(f"BEGIN;\n{script};\nPRAGMA user_version = {number};\nCOMMIT;")
+            version = number
+        return version
+    finally:
+        _close_db(conn, c)
+
+
+def migrate_all():
+    """
+    Creates the databases if they don't already exist and migrates all of them to the latest schema.
+    """
+    for path, migrations in MIGRATIONS.items():
+        migrate(path, migrations)
+
+
+if __name__ == '__main__':
+    migrate_all()
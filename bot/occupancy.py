@@ -0,0 +1,218 @@
+import argparse
+import math
+import time
+
+from db_utils import climatedb, _init_db, _close_db
+import snapshot
+
+"""
+Online estimate of the amount of people at the guildroom from the CO2 level.
+The room is modelled with a mass balance: every person adds CO2 to the air and
+ventilation pulls the level back towards the outdoor level,
+    dC/dt = generation * people - air_exchange * (C - outdoor_co2)
+A Kalman filter tracks the CO2 level and the amount of people through it,
+updated in constant time by the web process as every reading is saved.
+The state is persisted in climate.db so the bot and restarts can use it.
+
+Calibrate the model from the history with: python3 occupancy.py calibrate
+"""
+
+# The old linear model (people = 0.019 * co2 - 8.3) as a steady state of the mass balance:
+# air_exchange / generation = LEGACY_SLOPE and outdoor_co2 = LEGACY_OFFSET / LEGACY_SLOPE
+LEGACY_SLOPE = 0.018966699
+LEGACY_OFFSET = 8.308014998
+
+# Default parameters, roughly one air change per hour
+AIR_EXCHANGE = 1 / 3600  # 1/s
+OUTDOOR_CO2 = LEGACY_OFFSET / LEGACY_SLOPE  # ppm
+GENERATION = AIR_EXCHANGE / LEGACY_SLOPE  # ppm/s per person
+
+# Noise of the filter
+MEASUREMENT_VARIANCE = 25.0  # ppm^2, a sensor accurate to about 5 ppm
+CO2_PROCESS_VARIANCE = 0.05  # ppm^2/s
+PEOPLE_PROCESS_VARIANCE = 1 / 120  # people^2/s, people come and go
+# After a longer gap in the data the estimate starts over from the steady state
+MAX_GAP = 2 * 60 * 60  # s
+
+# Night hours (UTC) when the guildroom is assumed to be empty for calibration
+NIGHT_HOURS_UTC = range(0, 4)
+# Longest gap between readings used for calibration
+CALIBRATION_MAX_DT = 15 * 60  # s
+
+
+def load_params(c):
+    """
+    Returns the calibrated (air_exchange, generation, outdoor_co2) or the defaults.
+    """
+    row = c.execute("SELECT air_exchange, generation, outdoor_co2 FROM occupancy_params WHERE id = 1").fetchone()
+    return row if row else (AIR_EXCHANGE, GENERATION, OUTDOOR_CO2)
+
+
+class OccupancyEstimator:
+    """
+    Kalman filter over the state (co2, people). Owned by the ingest writer thread.
+    """
+
+    def __init__(self, params=(AIR_EXCHANGE, GENERATION, OUTDOOR_CO2), state=None):
+        self.air_exchange, self.generation, self.outdoor_co2 = params
+        # epoch, co2, people and the covariance matrix [[p00, p01], [p01, p11]]
+        self.epoch, self.co2, self.people, self.p00, self.p01, self.p11 = state or (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    @classmethod
+    def load(cls):
+        """
+        Restores the estimator from the database.
+        """
+        conn, c = _init_db(climatedb)
+        try:
+            params = load_params(c)
+            row = c.execute("SELECT timestamp, co2, people, p00, p01, p11 FROM occupancy_state WHERE id = 1").fetchone()
+        finally:
+            _close_db(conn, c)
+        state = (snapshot.to_epoch(row[0]),) + tuple(row[1:]) if row else None
+        return cls(params, state)
+
+    def _reset(self, epoch, co2):
+        """
+        Starts over from the steady state of the measured CO2 level.
+        """
+        self.epoch = epoch
+        self.co2 = co2
+        self.people = max(0.0, self.air_exchange / self.generation * (co2 - self.outdoor_co2))
+        self.p00 = MEASUREMENT_VARIANCE
+        self.p01 = 0.0
+        self.p11 = 4.0
+
+    def step(self, epoch, co2):
+        """
+        Updates the estimate with one CO2 reading.
+        Readings older than the last one and missing or non-finite values are ignored.
+        """
+        if co2 is None or not math.isfinite(co2):
+            return
+        dt = epoch - self.epoch
+        if dt <= 0:
+            return
+        if dt > MAX_GAP or self.epoch == 0:
+            self._reset(epoch, co2)
+            return
+
+        # Predict: x = F x + u with F = [[f00, g], [0, 1]], the exact solution of the mass balance
+        # over dt with the people constant. Unlike a forward Euler step (f00 = 1 - a) it stays stable for any gap.
+        a = self.air_exchange * dt
+        f00 = math.exp(-a)
+        # (1 - f00) / a, which tends to 1 without ventilation
+        decay = -math.expm1(-a) / a if a > 0 else 1.0
+        g = self.generation * dt * decay
+        co2_pred = f00 * self.co2 + g * self.people + (1.0 - f00) * self.outdoor_co2
+        people_pred = self.people
+        # P = F P F^T + Q
+        p00 = (f00 * f00 * self.p00 + 2 * f00 * g * self.p01 + g * g * self.p11
+               + CO2_PROCESS_VARIANCE * dt)
+        p01 = f00 * self.p01 + g * self.p11
+        p11 = self.p11 + PEOPLE_PROCESS_VARIANCE * dt
+
+        # Update with the measured CO2 level
+        s = p00 + MEASUREMENT_VARIANCE
+        k0 = p00 / s
+        k1 = p01 / s
+        residual = co2 - co2_pred
+        self.co2 = co2_pred + k0 * residual
+        # Negative people make no sense (even if it was kinda funny)
+        self.people = max(0.0, people_pred + k1 * residual)
+        self.p00 = (1 - k0) * p00
+        self.p01 = (1 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        self.epoch = epoch
+
+    def update(self, readings):
+        """
+        Updates the estimate with a batch of saved Readings and persists the state.
+        """
+        for reading in sorted(readings, key=lambda r: r.timestamp or ""):
+            epoch = snapshot.to_epoch(reading.timestamp) if reading.timestamp else time.time()
+            self.step(epoch, reading.co2)
+
+        conn, c = _init_db(climatedb)
+        try:
+            c.execute("""
+                      INSERT OR REPLACE INTO occupancy_state (id, timestamp, co2, people, p00, p01, p11)
+                      VALUES (1, ?, ?, ?, ?, ?, ?)
+                      """,
+                      (snapshot.to_timestamp(self.epoch), self.co2, self.people, self.p00, self.p01, self.p11))
+            conn.commit()
+        finally:
+            _close_db(conn, c)
+        return self.people
+
+
+def saved_estimate():
+    """
+    Returns the latest persisted estimate of people or None if there is none.
+    """
+    conn, c = _init_db(climatedb)
+    try:
+        row = c.execute("SELECT people FROM occupancy_state WHERE id = 1").fetchone()
+    finally:
+        _close_db(conn, c)
+    return row[0] if row else None
+
+
+def calibrate():
+    """
+    Fits the air exchange rate and the outdoor CO2 level to the history with least squares.
+    During the night the room is assumed to be empty, so dC/dt = -air_exchange * C + air_exchange * outdoor_co2.
+    There's no record of how many people were actually there, so the generation keeps
+    the steady state of the old linear model. Returns the fitted parameters.
+    Only the raw rows still in the database are used, i.e. the last retention.RETENTION_DAYS days,
+    which keeps the fit to the current ventilation. The archived data is left out.
+    """
+    import numpy as np
+    import climate_series
+
+    conn, c = _init_db(climatedb)
+    try:
+        series = climate_series.fetch_arrays(c, climate_series.RAW_QUERY,
+                                             ("0000-00-00 00:00:00", "9999-12-31 23:59:59"))
+    finally:
+        _close_db(conn, c)
+
+    times = series["time"].astype(np.int64)
+    co2 = series["co2"].astype(np.float64)
+    dt = np.diff(times)
+    hours = (times[:-1] // 3600) % 24
+    night = (dt > 0) & (dt <= CALIBRATION_MAX_DT) & np.isin(hours, NIGHT_HOURS_UTC)
+    if night.sum() < 10:
+        raise ValueError("Not enough night time data to calibrate")
+
+    slope_dt = np.diff(co2)[night] / dt[night]
+    design = np.column_stack([co2[:-1][night], np.ones(night.sum())])
+    (slope, intercept), *_ = np.linalg.lstsq(design, slope_dt, rcond=None)
+    air_exchange = -slope
+    if air_exchange <= 0:
+        raise ValueError("CO2 didn't decay during the night, can't calibrate")
+    outdoor_co2 = intercept / air_exchange
+    generation = air_exchange / LEGACY_SLOPE
+
+    conn, c = _init_db(climatedb)
+    try:
+        c.execute("""
+                  INSERT OR REPLACE INTO occupancy_params (id, air_exchange, generation, outdoor_co2)
+                  VALUES (1, ?, ?, ?)
+                  """,
+                  (air_exchange, generation, outdoor_co2))
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+    return air_exchange, generation, outdoor_co2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Occupancy model of the guildroom")
+    parser.add_argument("command", choices=["calibrate"])
+    parser.parse_args()
+    exchange, gen, outdoor = calibrate()
+    print(f"Air exchange: {exchange * 3600:.2f} 1/h\n"
+          f"Generation: {gen * 3600:.1f} ppm/h per person\n"
+          f"Outdoor CO2: {outdoor:.0f} ppm\n"
+          "Restart the web app to use the new parameters.")
@@ -1,68 +1,109 @@
-import os
-import sqlite3
+import io
 from datetime import datetime, timedelta
 import pytz
-import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
 from matplotlib.dates import DateFormatter
 from matplotlib import dates, ticker
 from zoneinfo import ZoneInfo
+import climate_series
+from downsample import lttb
 
+# Max amount of points per series. Longer time ranges are read from the rollup tables
+# and everything is downsampled to this before plotting.
+MAX_POINTS = 2000
 
-def plotting():
+# Figure reused for every plot instead of creating (and leaking) a new one each time
+_figure = None
+
+
+def warm_up():
+    """
+    Prepares everything needed for plotting in advance, so the first plot is as quick as the rest.
+    """
+    global _figure
+    if _figure is None:
+        _figure = Figure()
+        _figure.subplots(3, 1)
+    return _figure
+
+
+def _time_locators(span, tz):
+    """
+    Returns the major and minor locators and the label format of the time axis for a time span.
+    """
+    if span <= timedelta(days=1, hours=1):
+        return dates.HourLocator(interval=3, tz=tz), dates.HourLocator(interval=1, tz=tz), "%H:%M"
+    if span <= timedelta(days=8):
+        return dates.DayLocator(tz=tz), dates.HourLocator(byhour=(0, 6, 12, 18), tz=tz), "%d.%m"
+    if span <= timedelta(days=62):
+        return dates.WeekdayLocator(byweekday=dates.MO, tz=tz), dates.DayLocator(tz=tz), "%d.%m"
+    if span <= timedelta(days=190):
+        return dates.MonthLocator(tz=tz), dates.WeekdayLocator(byweekday=dates.MO, tz=tz), "%m/%y"
+    if span <= timedelta(days=731):
+        return dates.MonthLocator(bymonth=(1, 4, 7, 10), tz=tz), dates.MonthLocator(tz=tz), "%m/%y"
+    return dates.YearLocator(tz=tz), dates.MonthLocator(tz=tz), "%Y"
+
+
+def _downsampled(series, column):
+    """
+    Returns the times and values of a column reduced to MAX_POINTS with LTTB.
     """
-    Draws a climate data plot of the last 24h.
+    valid = ~np.isnan(series[column])
+    times, values = series['time'][valid], series[column][valid]
+    selected = lttb(times.astype('int64'), values, MAX_POINTS)
+    return times[selected], values[selected]
+
+
+def plotting(t_start_local=None, t_end_local=None, label="24h"):
+    """
+    Draws a climate data plot between two timezone aware datetimes and returns it as png bytes.
+    By default the last 24h. Relative time ranges are labeled with label (e.g. "7d"),
+    absolute ones (label=None) with their start and end.
     If no data vailable, the plot will be empty.
     """
     # Timezones
     helsinki_tz = pytz.timezone('Europe/Helsinki')
 
-    # Timerange to be the last 24h (in Helsinki time)
-    t_end_local = datetime.now(helsinki_tz)
-    t_start_local = t_end_local - timedelta(days=1)
+    # Timerange to be the last 24h (in Helsinki time) by default
+    if t_end_local is None:
+        t_end_local = datetime.now(helsinki_tz)
+    if t_start_local is None:
+        t_start_local = t_end_local - timedelta(days=1)
+    t_end_local = t_end_local.astimezone(helsinki_tz)
+    t_start_local = t_start_local.astimezone(helsinki_tz)
 
     # Timerange in UTC
     t_end_utc = t_end_local.astimezone(pytz.utc)
     t_start_utc = t_start_local.astimezone(pytz.utc)
 
-    # Format timestamps as string for SQL (UTC strings)
-    t_start_str = t_start_utc.strftime("%Y-%m-%d %H:%M:%S")
-    t_end_str = t_end_utc.strftime("%Y-%m-%d %H:%M:%S")
-
-    # Register datetime converter to ensure correct plotting by matplotlib
-    pd.plotting.register_matplotlib_converters()
-
-    # SQL query and connection
-    conn = sqlite3.connect("climate.db")
-
-    query = """
-        SELECT timestamp, temperature, co2, humidity
-        FROM climate_data
-        WHERE timestamp BETWEEN ? AND ?
-        ORDER BY timestamp ASC
-    """
-
-    df = pd.read_sql_query(query, conn, params=(t_start_str, t_end_str))
-    conn.close()
+    series = climate_series.load_climate(t_start_utc, t_end_utc, MAX_POINTS)
 
-    # Convert timestamp column to datetime and localize
-    df['time'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert(ZoneInfo("Europe/Helsinki"))
+    if label:
+        title = t_end_local.strftime(f'Last {label} of Kiltis %d.%m.%Y at %H:%M:%S')
+    else:
+        title = f"Kiltis {t_start_local.strftime('%d.%m.%Y')} - {t_end_local.strftime('%d.%m.%Y')}"
 
     # Plot data and show results
-    fig, axs = plt.subplots(3, 1)
+    fig = warm_up()
+    axs = fig.axes
+    fig.suptitle(title, fontsize=20)
+    tz = ZoneInfo("Europe/Helsinki")
     # Format the shared x-axis and other shared information.
     for ax in axs:
-        ax.xaxis.set_major_formatter(DateFormatter("%H:%M", tz=ZoneInfo("Europe/Helsinki")))
-        ax.xaxis.set_major_locator(dates.HourLocator(interval=3))
-        ax.xaxis.set_minor_locator(dates.HourLocator(interval=1))
-        plt.suptitle(t_end_local.strftime('Last 24h of Kiltis %d.%m.%Y at %H:%M:%S'), fontsize=20)
+        ax.clear()
+        major, minor, time_format = _time_locators(t_end_local - t_start_local, tz)
+        ax.xaxis.set_major_formatter(DateFormatter(time_format, tz=tz))
+        ax.xaxis.set_major_locator(major)
+        ax.xaxis.set_minor_locator(minor)
+        ax.set_xlim(t_start_local, t_end_local)
         ax.grid(which="major", axis="x", linestyle="-")
         ax.grid(which="minor", axis="x", linestyle="--")
 
     # Format the individual subplots and their axis.
 
     ax = axs[0]
-    ax.scatter(x=df.time, y=df.co2, s=2, color='green')
+    ax.scatter(*_downsampled(series, 'co2'), s=2, color='green')
     ax.set_ylabel('CO2 (ppm)')
     ax.yaxis.set_major_locator(ticker.MultipleLocator(base=200))
     ax.yaxis.set_minor_locator(ticker.MultipleLocator(base=100))
@@ -70,7 +111,7 @@ def plotting():
     ax.grid(which="minor", axis="y", linestyle="--")
 
     ax = axs[1]
-    ax.scatter(x=df.time, y=df.temperature, s=2, color='red')
+    ax.scatter(*_downsampled(series, 'temperature'), s=2, color='red')
     ax.set_ylabel('Temp (°C)')
     ax.yaxis.set_major_locator(ticker.MultipleLocator(base=1))
     ax.yaxis.set_minor_locator(ticker.MultipleLocator(base=0.5))
@@ -78,13 +119,14 @@ def plotting():
     ax.grid(which="minor", axis="y", linestyle="--")
 
     ax = axs[2]
-    ax.scatter(x=df.time, y=df.humidity, s=2, color='blue')
+    ax.scatter(*_downsampled(series, 'humidity'), s=2, color='blue')
     ax.set_ylabel('Humidity (RH%)')
     ax.yaxis.set_major_locator(ticker.MultipleLocator(base=5))
     ax.yaxis.set_minor_locator(ticker.MultipleLocator(base=2.5))
     ax.grid(which="major", axis="y", linestyle="-")
     ax.grid(which="minor", axis="y", linestyle="--")
 
-    os.makedirs('plots', exist_ok=True)
-    # Save the figure as a png to a location
-    plt.savefig(os.path.join('plots', 'newest.png'))
+    # Render the figure as png bytes, no shared file for simultaneous plots to race on
+    png = io.BytesIO()
+    fig.savefig(png, format='png')
+    return png.getvalue()
@@ -0,0 +1,135 @@
+import asyncio
+import glob
+import multiprocessing
+import os
+from multiprocessing import util
+
+from logger import logger
+import metrics
+
+"""
+Plots are rendered in a small pool of worker processes, so matplotlib and NumPy
+never block the bot's event loop and never get imported into the bot process.
+Workers import everything and create their figure when they start and
+are replaced after MAX_RENDERS plots to keep their memory use in check.
+A plot is only handed to the pool when a worker is free, so TIMEOUT counts the rendering and not the wait.
+A stuck plot restarts the workers, the other plots being rendered at the time are rendered again by the new ones.
+Every worker takes one of WORKERS slots and saves its metrics (e.g. the sqlite timings of plotting)
+as metrics/plot-<slot>.json. A worker replacing another continues from the file of the slot,
+so there are never more files than workers. The files of an earlier run of the bot are removed when the pool starts.
+"""
+
+WORKERS = 2
+MAX_RENDERS = 50
+# Seconds to wait for a plot before giving up and restarting the workers
+TIMEOUT = 30
+
+_pool = None
+_old_metrics_removed = False
+# Plots handed to the pool at most, one for every worker
+_free_workers = asyncio.Semaphore(WORKERS)
+# future of a plot being rendered: the pool rendering it
+_rendering = {}
+
+
+class _Restarted(Exception):
+    """
+    The workers were restarted because of another plot while this one was being rendered.
+    """
+
+
+def _init_worker(slots):
+    slot = slots.get()
+    metrics.start(f"plot-{slot}", resume=True)
+    # Workers exit without running atexit, this saves what was counted since the last periodic save
+    # and then hands the slot over to the worker replacing this one
+    util.Finalize(None, metrics.flush, exitpriority=10)
+    util.Finalize(None, slots.put, args=(slot,), exitpriority=9)
+    import plot_data
+    plot_data.warm_up()
+
+
+def _render(*args):
+    import plot_data
+    return plot_data.plotting(*args)
+
+
+def start():
+    """
+    Starts the worker processes if they aren't running yet.
+    """
+    global _pool, _old_metrics_removed
+    if not _old_metrics_removed:
+        # Left by an earlier run of the bot
+        for path in glob.glob(os.path.join(metrics.METRICS_DIR, "plot-*.json")):
+            os.remove(path)
+        _old_metrics_removed = True
+    if _pool is None:
+        context = multiprocessing.get_context("spawn")
+        slots = context.SimpleQueue()
+        for slot in range(WORKERS):
+            slots.put(slot)
+        _pool = context.Pool(WORKERS, initializer=_init_worker, initargs=(slots,), maxtasksperchild=MAX_RENDERS)
+    return _pool
+
+
+def stop():
+    """
+    Kills the worker processes, plots in progress are lost.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+def _restart(pool):
+    """
+    Replaces the workers if they still are the ones in pool, the other plots they were rendering
+    are rendered again by the new workers.
+    """
+    if _pool is not pool:
+        return
+    logger.error("Plot rendering timed out, restarting plot workers")
+    stop()
+    for future, rendered_by in _rendering.items():
+        if rendered_by is pool and not future.done():
+            future.set_exception(_Restarted())
+
+
+async def render(*args):
+    """
+    Renders a plot with plot_data.plotting(*args) in a worker and returns the png bytes.
+    """
+    async with _free_workers:
+        while True:
+            try:
+                return await _render_once(args)
+            except _Restarted:
+                logger.warning("Plot workers were restarted during rendering, rendering again")
+
+
+async def _render_once(args):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result):
+        if not future.done():
+            future.set_result(result)
+
+    def reject(error):
+        if not future.done():
+            future.set_exception(error)
+
+    pool = start()
+    _rendering[future] = pool
+    pool.apply_async(_render, args,
+                     callback=lambda result: loop.call_soon_threadsafe(resolve, result),
+                     error_callback=lambda error: loop.call_soon_threadsafe(reject, error))
+    try:
+        return await asyncio.wait_for(future, TIMEOUT)
+    except asyncio.TimeoutError:
+        _restart(pool)
+        raise RuntimeError("Plotting took too long")
+    finally:
+        del _rendering[future]
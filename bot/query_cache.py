@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+import metrics
+
+"""
+In-process cache of search results, so a repeated /quote, /joke or /virpi search doesn't query the database again.
+Every database has its own cache with a generation counter. The commands that change the database
+bump it, which makes every result cached before the change stale.
+Only the candidates are cached, the caller still picks a random one of them every time.
+"""
+
+# How many results and how many candidates in total a cache keeps at most
+MAX_ENTRIES = 256
+MAX_CANDIDATES = 200_000
+
+
+def fold_ascii(text):
+    """
+    Lowercases the ASCII letters of text, the same letters sqlite's LIKE ignores the case of.
+    """
+    return "".join(ch.lower() if ch.isascii() else ch for ch in text)
+
+
+class QueryCache:
+    """
+    LRU cache of search results (tuples of candidates) by a normalized query.
+    """
+
+    def __init__(self, name, max_entries=MAX_ENTRIES, max_candidates=MAX_CANDIDATES):
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.generation = 0
+        self._labels = (("cache", name),)
+        # key: (generation, candidates)
+        self._entries = OrderedDict()
+        self._candidates = 0
+
+    def get(self, key, search):
+        """
+        Returns the cached candidates for key or calls search() to find them.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == self.generation:
+            self._entries.move_to_end(key)
+            metrics.registry.inc("kiltisbot_query_cache_hits_total", self._labels)
+            return entry[1]
+
+        metrics.registry.inc("kiltisbot_query_cache_misses_total", self._labels)
+        generation = self.generation
+        candidates = tuple(search())
+        self._store(key, generation, candidates)
+        return candidates
+
+    def _store(self, key, generation, candidates):
+        if len(candidates) > self.max_candidates:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._candidates -= len(old[1])
+        self._entries[key] = (generation, candidates)
+        self._candidates += len(candidates)
+        while len(self._entries) > self.max_entries or self._candidates > self.max_candidates:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._candidates -= len(evicted)
+
+    def invalidate(self):
+        """
+        Makes every cached result stale, call after changing the database.
+        """
+        self.generation += 1
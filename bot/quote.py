@@ -1,10 +1,32 @@
+import bisect
+import html
 import random
-import sqlite3
 import logging
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
-from db_utils import quotedb, _init_db
+from db_utils import quotedb, _init_db, _close_db
 from logger import logger
+from query_cache import QueryCache
+
+# BM25 weights of a match in the quote text, the name of the quotee and the tags
+SEARCH_WEIGHTS = (1.0, 4.0, 2.0)
+
+# (chat_id, search words): the message ids of every matching quote with their cumulative BM25 scores
+_search_cache = QueryCache("quote")
+
+# chat_id: message ids of the quotes of the chat, for picking a random quote without sorting them all.
+# Only the bot adds and deletes quotes, keeping the ids here up to date whenever it does.
+_quote_ids = {}
+
+# /listquotes shows this many quotes per page
+LIST_PAGE_SIZE = 20
+# The texts and tags are shortened in the list so a page usually fits in one message
+LIST_TEXT_LENGTH = 120
+LIST_TAGS_LENGTH = 40
+# Telegram's limit for the length of a message in UTF-16 code units, a longer page is cut short
+LIST_MESSAGE_LENGTH = 4096
+# Prefix of the callback data of the previous and next buttons of /listquotes
+LIST_CALLBACK = "listquotes"
 
 
 def _get_message_args(string):
@@ -14,68 +36,93 @@ def _get_message_args(string):
     return " ".join([tag for tag in string.split() if tag[0] != '/'])
 
 
-def _search_msg_id(chat_id, args):
+def _fts_query(args):
     """
-    Fetches a random possible meaning of search term
-    (only text, first name and text or full name and text)
-    one arg at a time. For getting quotes.
+    Turns search words into an FTS5 query matching quotes with all of the words.
+    Every word is quoted so it's never read as FTS5 syntax and matched as a prefix, so "oskar" finds "oskari".
+    Returns None if there's nothing to search for.
     """
-    def like(string):
-        return "%{}%".format(string)
+    terms = ['"{}"*'.format(arg.replace('"', '""')) for arg in args if any(ch.isalnum() for ch in arg)]
+    return " ".join(terms) if terms else None
+
 
+def _search_candidates(chat_id, query):
+    """
+    Returns every quote of the chat matching an FTS5 query as (message_id, cumulative score) pairs.
+    The score of a quote is its BM25 rank (a match in the name weighs the most), the better the match the higher.
+    """
     conn, c = _init_db(quotedb)
-    results = []
     try:
-        for arg in args:
-            ret = c.execute("""
-                            SELECT message_id
-                            FROM quotes
-                            WHERE chat_id=:id
-                            AND said_by LIKE :arg
-                            """,
-                            {"id": str(chat_id), "arg": like(arg)}
-                            ).fetchall()
-            ret += c.execute("""
-                             SELECT message_id
-                             FROM quotes
-                             WHERE chat_id=:id
-                             AND quote_text LIKE :arg
-                             """,
-                             {"id": str(chat_id), "arg": like(arg)}
-                             ).fetchall()
-            ret += c.execute("""
-                             SELECT message_id
-                             FROM quotes
-                             WHERE chat_id=:id
-                             AND tags LIKE :arg
-                             """,
-                             {"id": str(chat_id), "arg": like(arg)}
-                             ).fetchall()
-            results.extend(ret)
+        # CROSS JOIN keeps sqlite from going through every quote of the chat and matching each of them on its own
+        ret = c.execute("""
+                        SELECT quotes.message_id,
+                               bm25(quotes_fts, :text_weight, :name_weight, :tag_weight)
+                        FROM quotes_fts
+                        CROSS JOIN quotes ON quotes.rowid = quotes_fts.rowid
+                        WHERE quotes_fts MATCH :query
+                        AND quotes.chat_id = :id
+                        """,
+                        {"query": query, "id": str(chat_id), "text_weight": SEARCH_WEIGHTS[0],
+                         "name_weight": SEARCH_WEIGHTS[1], "tag_weight": SEARCH_WEIGHTS[2]}
+                        ).fetchall()
     finally:
-        conn.close()
+        _close_db(conn, c)
+
+    candidates = []
+    total = 0.0
+    for message_id, rank in ret:
+        # bm25() is negative, the better the match the further below zero
+        total -= rank
+        candidates.append((message_id, total))
+    return candidates
+
+
+def _search_msg_id(chat_id, args):
+    """
+    Fetches a random quote of the chat matching all of the search words
+    in the text, the name of the quotee or the tags.
+    Every matching quote can be picked, the better it matches the more likely.
+    The matches of a search are cached, the pick among them is random every time.
+    """
+    # The search ignores the case and the order of the words
+    words = sorted({arg.lower() for arg in args})
+    query = _fts_query(words)
+    if query is None:
+        return None
+
+    candidates = _search_cache.get((chat_id, tuple(words)), lambda: _search_candidates(chat_id, query))
+    if not candidates:
+        return None
+    pick = random.uniform(0, candidates[-1][1])
+    return candidates[bisect.bisect_left(candidates, pick, key=lambda candidate: candidate[1])][0]
+
 
-    msg_id = random.choice(results)[0] if results else None
-    return msg_id
+def _chat_quote_ids(chat_id):
+    """
+    Returns the message ids of the quotes of a chat, reading them from the db on the first call.
+    """
+    ids = _quote_ids.get(chat_id)
+    if ids is None:
+        conn, c = _init_db(quotedb)
+        try:
+            ids = [row[0] for row in c.execute("""
+                                               SELECT message_id
+                                               FROM quotes
+                                               WHERE chat_id=?
+                                               """,
+                                               (str(chat_id),)).fetchall()]
+        finally:
+            _close_db(conn, c)
+        _quote_ids[chat_id] = ids
+    return ids
 
 
 def _random_msg_id(chat_id):
     """
     Returns a random quote from the same chat as the request
     """
-    conn, c = _init_db(quotedb)
-    ret = None
-    try:
-        ret = c.execute("""
-                        SELECT message_id
-                        FROM quotes
-                        WHERE chat_id=?
-                        ORDER BY RANDOM() LIMIT 1
-                        """,
-                        (str(chat_id),)).fetchone()
-    finally:
-        conn.close()
-    return ret[0] if ret else None
+    ids = _chat_quote_ids(chat_id)
+    return random.choice(ids) if ids else None
 
 
 async def add_quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -111,19 +158,19 @@ async def add_quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Get "said_by" from the message being replied to
     if reply.from_user:
-        first_name = reply.from_user.first_name or ""
-        last_name = reply.from_user.last_name or ""
-        said_by = f"{first_name} {last_name}".strip().lower()
+        said_by = _user_fullname(reply.from_user)
+        said_by_id = reply.from_user.id
     else:
         said_by = "unknown"
+        said_by_id = None
 
     # Get "added_by" from the person who issued the command
     if message.from_user:
-        sfname = message.from_user.first_name or ""
-        slname = message.from_user.last_name or ""
-        added_by = f"{sfname} {slname}".strip().lower()
+        added_by = _user_fullname(message.from_user)
+        added_by_id = message.from_user.id
     else:
         added_by = "unknown"
+        added_by_id = None
 
     said_date = reply.date.strftime("%Y.%m.%d %H:%M")
     added_date = message.date.strftime("%Y.%m.%d %H:%M")
@@ -131,9 +178,19 @@ async def add_quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     conn, c = _init_db(quotedb)
 
     try:
-        c.execute("INSERT INTO quotes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                  (quote_text, tags, message_id, chat_id, said_by, added_by, said_date, added_date))
+        if reply.from_user:
+            _claim_quotes(c, reply.from_user, chat_id)
+        c.execute("""
+                  INSERT INTO quotes (quote_text, tags, message_id, chat_id, said_by, added_by, said_date, added_date,
+                                      said_by_id, added_by_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                  """,
+                  (quote_text, tags, message_id, chat_id, said_by, added_by, said_date, added_date,
+                   said_by_id, added_by_id))
         conn.commit()
+        _search_cache.invalidate()
+        if chat_id in _quote_ids:
+            _quote_ids[chat_id].append(message_id)
         await update.message.reply_text("✅ Quote added ✅")
 
     except Exception as e:
@@ -153,6 +210,7 @@ async def add_quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                                 WHERE message_id = ?
                                 """, (new_tags, str(message_id)))
                     conn.commit()
+                    _search_cache.invalidate()
                     await update.message.reply_text("🔍 Message already added 🔍️\n"
                                                     "Tags updated.")
                 else:
@@ -170,7 +228,7 @@ async def add_quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                                             f"\n{e}")
 
     finally:
-        conn.close()
+        _close_db(conn, c)
 
 
 async def get_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,43 +254,183 @@ async def get_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                         reply_to_message_id=update.message.message_id)
 
 
+def _user_fullname(user):
+    """
+    Returns the name of a user the way said_by and added_by are saved
+    """
+    first_name = user.first_name or ""
+    last_name = user.last_name or ""
+    return (first_name + " " + last_name).strip().lower()
+
+
+def _claim_quotes(c, user, chat_id):
+    """
+    Sets the user id of the quotes of a chat saved under the name of the user before the ids were saved.
+    Only called with the author of a message quoted in the same chat, anyone can set their name to someone else's.
+    After this the quotes are found by the id, even if the user changes their name.
+    The caller commits.
+    """
+    c.execute("""
+              UPDATE quotes
+              SET said_by_id = ?
+              WHERE said_by = ?
+              AND chat_id = ?
+              AND said_by_id IS NULL
+              """,
+              (user.id, _user_fullname(user), chat_id))
+
+
+def _quote_page(said_by_id, after=None, before=None):
+    """
+    Returns a page of quotes of the user as (chat_id, rowid, quote_text, tags, message_id),
+    grouped by chat and in the order they were added.
+    The page is either the first one, the quotes right after the (chat_id, rowid) after
+    or the ones right before the (chat_id, rowid) before.
+    Also returns whether there are more quotes on the side the page was fetched from.
+    Each page is one range of the (said_by_id, chat_id) index, however many quotes the user has.
+    """
+    # The first page starts before the smallest possible chat id
+    after = after or (-2 ** 63, 0)
+    conn, c = _init_db(quotedb)
+    try:
+        if before is None:
+            ret = c.execute("""
+                            SELECT chat_id, rowid, quote_text, tags, message_id
+                            FROM quotes
+                            WHERE said_by_id = ?
+                            AND (chat_id, rowid) > (?, ?)
+                            ORDER BY chat_id, rowid
+                            LIMIT ?
+                            """,
+                            (said_by_id, *after, LIST_PAGE_SIZE + 1)).fetchall()
+        else:
+            ret = c.execute("""
+                            SELECT chat_id, rowid, quote_text, tags, message_id
+                            FROM quotes
+                            WHERE said_by_id = ?
+                            AND (chat_id, rowid) < (?, ?)
+                            ORDER BY chat_id DESC, rowid DESC
+                            LIMIT ?
+                            """,
+                            (said_by_id, *before, LIST_PAGE_SIZE + 1)).fetchall()
+    finally:
+        _close_db(conn, c)
+
+    more = len(ret) > LIST_PAGE_SIZE
+    ret = ret[:LIST_PAGE_SIZE]
+    return (ret if before is None else ret[::-1]), more
+
+
+def _shorten(text, length):
+    return text if len(text) <= length else text[:length - 1] + "…"
+
+
+def _format_quote_page(rows, page):
+    """
+    Returns the text of a page of /listquotes starting from quote number page * LIST_PAGE_SIZE + 1
+    """
+    return "\n\n".join([
+        f"<b>{page * LIST_PAGE_SIZE + i + 1}:</b>\n"
+        f"<b>Quote:</b> {html.escape(_shorten(t[2], LIST_TEXT_LENGTH)) if t[2] else 'VoiceMessage'}\n"
+        f"<b>Tags:</b> {html.escape(_shorten(t[3], LIST_TAGS_LENGTH)) if t[3] else 'None'}\n"
+        f"<b>ID:</b> {t[4]}"
+        for i, t in enumerate(rows)
+    ])
+
+
+def _fit_quote_page(rows, page, keep_last=False):
+    """
+    Returns the text of a page of /listquotes and the rows on it, leaving out rows from the end
+    (or from the start if keep_last) until the text fits in one message.
+    Escaping the HTML and characters outside the BMP (e.g. emojis) can make a full page too long.
+    """
+    text = _format_quote_page(rows, page)
+    while len(rows) > 1 and len(text.encode("utf-16-le")) // 2 > LIST_MESSAGE_LENGTH:
+        rows = rows[1:] if keep_last else rows[:-1]
+        text = _format_quote_page(rows, page)
+    return text, rows
+
+
+def _quote_page_keyboard(rows, page, has_previous, has_next):
+    """
+    Returns the previous and next buttons of a page of /listquotes, or None if there are no other pages
+    """
+    buttons = []
+    if has_previous:
+        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"{LIST_CALLBACK}:prev:{rows[0][0]}:{rows[0][1]}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"{LIST_CALLBACK}:next:{rows[-1][0]}:{rows[-1][1]}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 async def list_quotes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Lists all quotes of a user to them in private chat
+    Lists all quotes of a user to them in private chat,
+    LIST_PAGE_SIZE at a time with buttons for the previous and next pages
     """
     if update.message.chat.type != "private":
         return
-    conn, c = _init_db(quotedb)
     try:
-        first_name = update.message.chat.first_name or ""
-        last_name = update.message.chat.last_name or ""
-        user_fullname = (first_name + " " + last_name).strip().lower()
-
-        ret = c.execute("""
-                        SELECT quote_text, tags, message_id
-                        FROM quotes
-                        WHERE said_by = ?
-                        """,
-                        (user_fullname,)).fetchall()
-        if not ret:
+        rows, has_next = _quote_page(update.effective_user.id)
+        if not rows:
             await update.message.reply_text("❌ You have no quotes saved ❌")
             return
 
-        text = "\n\n".join([
-            f"<b>{i + 1}:</b>\n"
-            f"<b>Quote:</b> {(t[0] if t[0] else 'VoiceMessage')}\n"
-            f"<b>Tags:</b> {(t[1] if t[1] else 'None')}\n"
-            f"<b>ID:</b> {t[2]}"
-            for i, t in enumerate(ret)
-        ])
+        text, shown = _fit_quote_page(rows, 0)
+        has_next = has_next or len(shown) < len(rows)
         await update.message.reply_text(text,
-                                        parse_mode="HTML")
+                                        parse_mode="HTML",
+                                        reply_markup=_quote_page_keyboard(shown, 0, False, has_next))
     except Exception as e:
         logger.exception("Error in list_quotes")
         await update.message.reply_text("⚠️ Error occurred while listing your quotes ⚠️")
-    finally:
-        if conn:
-            conn.close()
+
+
+async def list_quotes_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Shows the previous or next page of /listquotes in place of the current one.
+    The callback data is "listquotes:<prev|next>:<chat_id>:<rowid>:<page>"
+    with the chat_id and rowid of the first or the last quote on the current page.
+    """
+    query = update.callback_query
+    await query.answer()
+    if update.effective_chat.type != "private":
+        return
+    try:
+        _, direction, chat_id, rowid, page = query.data.split(":")
+        key, page = (int(chat_id), int(rowid)), int(page)
+    except ValueError:
+        return
+
+    try:
+        said_by_id = update.effective_user.id
+        if direction == "next":
+            rows, has_next = _quote_page(said_by_id, after=key)
+            has_previous = page > 0
+        else:
+            rows, has_previous = _quote_page(said_by_id, before=key)
+            has_next = True
+        if not rows:
+            await query.edit_message_text("❌ You have no more quotes saved ❌")
+            return
+
+        text, shown = _fit_quote_page(rows, page, keep_last=direction != "next")
+        if len(shown) < len(rows):
+            # The rows left out are on the following page in the same direction
+            if direction == "next":
+                has_next = True
+            else:
+                has_previous = True
+        if not has_previous and page:
+            page = 0
+            text = _format_quote_page(shown, page)
+
+        await query.edit_message_text(text,
+                                      parse_mode="HTML",
+                                      reply_markup=_quote_page_keyboard(shown, page, has_previous, has_next))
+    except Exception as e:
+        logger.exception("Error in list_quotes_page")
+        await query.edit_message_text("⚠️ Error occurred while listing your quotes ⚠️")
 
 
 async def delete_quote(update: Update, context: ContextTypes.DEFAULT_TYPE): 
@@ -255,18 +453,20 @@ async def delete_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         target_id = int(args[1])
-        sfname = update.message.chat.first_name.lower() or ""
-        slname = update.message.chat.last_name.lower() or ""
-        user = f"{sfname} {slname}".strip().lower()
-
         deleted = c.execute("""
             DELETE FROM quotes
-            WHERE said_by = ?
+            WHERE said_by_id = ?
             AND message_id = ?
-        """, (user, target_id))
+            RETURNING chat_id, message_id
+        """, (update.effective_user.id, target_id)).fetchall()
         conn.commit()
 
-        if deleted.rowcount > 0:
+        if deleted:
+            _search_cache.invalidate()
+            for chat_id, message_id in deleted:
+                ids = _quote_ids.get(chat_id)
+                if ids is not None and message_id in ids:
+                    ids.remove(message_id)
             await update.message.reply_text("✅ Quote removed ✅")
         else:
             await update.message.reply_text(
@@ -279,4 +479,4 @@ async def delete_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"⚠️ Error removing quote ⚠️\n"
                                         f"{e}")
     finally:
-        conn.close()
+        _close_db(conn, c)
@@ -0,0 +1,43 @@
+import asyncio
+from collections import OrderedDict
+
+"""
+In-memory cache for rendered plots.
+A plot only changes when new climate data arrives, so the rendered PNG is kept
+under a key describing the plot and the newest data in it.
+"""
+
+
+class RenderCache:
+    """
+    LRU cache of PNG bytes. Concurrent requests for the same key share a single render.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    async def get(self, key, render):
+        """
+        Returns the cached PNG for key or awaits render() to create it.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(render())
+            self._pending[key] = task
+            task.add_done_callback(lambda done: self._store(key, done))
+        # A request giving up must not cancel the render for the others
+        return await asyncio.shield(task)
+
+    def _store(self, key, task):
+        self._pending.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = task.result()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
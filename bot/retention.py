@@ -0,0 +1,152 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from db_utils import climatedb, _init_db, _close_db
+
+"""
+Retention of the raw climate data.
+Raw rows older than RETENTION_DAYS are moved from climate.db into compressed per-month
+columnar archive files (archive/climate-YYYY-MM.npz) and the database is vacuumed.
+The hour and day rollups stay in the database, so long time ranges don't need the archive at all.
+Meant to be run daily, e.g. from cron: python3 retention.py
+"""
+
+ARCHIVE_DIR = "archive"
+RETENTION_DAYS = 90
+
+# Columns of an archive file, a missing sensor_id or sequence is saved as -1
+_COLUMNS = ("time", "co2", "temperature", "humidity", "sensor_id", "sequence")
+# Types of the columns in the file
+DTYPES = {"time": np.int64, "co2": np.float32, "temperature": np.float32, "humidity": np.float32,
+          "sensor_id": np.int32, "sequence": np.int64}
+
+
+def cutoff(retention_days=RETENTION_DAYS):
+    """
+    Returns the UTC datetime before which raw climate data is kept only in the archive.
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return now - timedelta(days=retention_days)
+
+
+def _archive_path(month):
+    """
+    Archive file of a numpy datetime64 month.
+    """
+    return os.path.join(ARCHIVE_DIR, f"climate-{month}.npz")
+
+
+def _read_archive(path):
+    """
+    Returns the columns of an archive file or None if it doesn't exist.
+    Files archived before the sensor ids and sequences were saved get -1 for them.
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as archive:
+        size = len(archive["time"])
+        return {column: archive[column] if column in archive.files else np.full(size, -1, dtype=DTYPES[column])
+                for column in _COLUMNS}
+
+
+def _write_archive(path, columns):
+    """
+    Replaces an archive file atomically, so a crash never leaves a half-written file behind.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _merge(old, new):
+    """
+    Merges two sets of archive columns sorted by time.
+    Exact duplicates, left behind by an interrupted earlier run, are dropped.
+    """
+    columns = {column: np.concatenate([old[column], new[column]]) for column in _COLUMNS}
+    order = np.lexsort([columns[column] for column in reversed(_COLUMNS)])
+    columns = {column: values[order] for column, values in columns.items()}
+    duplicate = np.ones(len(order), dtype=bool)
+    for values in columns.values():
+        duplicate[1:] &= values[1:] == values[:-1]
+    duplicate[0] = False
+    return {column: values[~duplicate] for column, values in columns.items()}
+
+
+def archive_old_rows(retention_days=RETENTION_DAYS):
+    """
+    Moves raw climate rows older than retention_days into the monthly archive files
+    and vacuums the database. Returns the amount of archived rows.
+    The archives are written without holding the write lock, which would keep the web app from saving readings.
+    Only the rows read for them are deleted afterwards, old rows saved in the meantime are left for the next run.
+    """
+    cutoff_str = cutoff(retention_days).strftime("%Y-%m-%d %H:%M:%S")
+    conn, c = _init_db(climatedb)
+    try:
+        rows = c.execute("""
+                         SELECT id, CAST(strftime('%s', timestamp) AS INTEGER), co2, temperature, humidity,
+                                IFNULL(sensor_id, -1), IFNULL(sequence, -1)
+                         FROM climate_data
+                         WHERE timestamp < ?
+                         """,
+                         (cutoff_str,)).fetchall()
+        if not rows:
+            return 0
+
+        # float64 holds the ids, the epochs and the uint32 sequences exactly
+        data = np.array(rows, dtype=np.float64)
+        last_id = int(data[:, 0].max())
+        data = data[:, 1:]
+        times = data[:, 0].astype(np.int64)
+        months = times.astype("datetime64[s]").astype("datetime64[M]")
+        for month in np.unique(months):
+            selected = months == month
+            new = {column: data[selected, i].astype(DTYPES[column]) for i, column in enumerate(_COLUMNS)}
+            path = _archive_path(month)
+            old = _read_archive(path) or {column: values[:0] for column, values in new.items()}
+            _write_archive(path, _merge(old, new))
+
+        # New rows get larger ids than any row read above, so only archived rows are deleted
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM climate_data WHERE id <= ? AND timestamp < ?", (last_id, cutoff_str))
+        # Minute rollups are about as big as the raw data, hours and days are kept forever
+        c.execute("DELETE FROM climate_rollup WHERE resolution = 60 AND bucket < ?", (cutoff_str,))
+        conn.commit()
+    finally:
+        _close_db(conn, c)
+
+    conn.execute("VACUUM")
+    return len(rows)
+
+
+def load_archive(t_start, t_end):
+    """
+    Returns the archived climate data between two UTC datetimes as numpy columns sorted by time.
+    Times are datetime64[s] in UTC.
+    """
+    start = np.datetime64(t_start.replace(tzinfo=None), "s")
+    end = np.datetime64(t_end.replace(tzinfo=None), "s")
+    parts = []
+    for month in np.arange(start.astype("datetime64[M]"), end.astype("datetime64[M]") + 1):
+        columns = _read_archive(_archive_path(month))
+        if columns is None:
+            continue
+        times = columns["time"].astype("datetime64[s]")
+        selected = (times >= start) & (times <= end)
+        parts.append({column: values[selected] for column, values in columns.items()})
+
+    result = {column: np.concatenate([part[column] for part in parts]) if parts else np.empty(0)
+              for column in _COLUMNS}
+    result["time"] = result["time"].astype("int64").astype("datetime64[s]")
+    return result
+
+
+if __name__ == '__main__':
+    print(f"Archiving climate data older than {RETENTION_DAYS} days...")
+    print(f"Archived {archive_old_rows()} rows.")
@@ -0,0 +1,66 @@
+from db_utils import climatedb, backfill_climate_rollup, _init_db, _close_db
+
+"""
+Minute, hour and day aggregates of the climate data.
+The climate_rollup table is kept up to date by a trigger on climate_data (see db_utils),
+this module picks the right resolution for a time range and rebuilds the table when needed.
+Usage for rebuilding: python3 rollups.py
+"""
+
+# Bucket lengths in seconds, from finest to coarsest
+RESOLUTIONS = (60, 3600, 86400)
+
+# Averages of the buckets as (timestamp, co2, temperature, humidity) rows, like the raw data in climate_series
+ROLLUP_QUERY = """
+    SELECT bucket,
+           co2_sum / count,
+           temperature_sum / count,
+           humidity_sum / count
+    FROM climate_rollup
+    WHERE resolution = ?
+    AND bucket BETWEEN ? AND ?
+    ORDER BY bucket ASC
+"""
+
+
+def pick_resolution(c, t_start, t_end, max_points):
+    """
+    Returns the finest rollup resolution which keeps the time range within max_points,
+    or None if the raw rows already fit.
+    t_start and t_end are UTC datetimes.
+    """
+    start_str = t_start.strftime("%Y-%m-%d %H:%M:%S")
+    end_str = t_end.strftime("%Y-%m-%d %H:%M:%S")
+    # The hourly counts are a cheap estimate of the amount of raw rows
+    raw_count = c.execute("""
+                          SELECT SUM(count)
+                          FROM climate_rollup
+                          WHERE resolution = 3600
+                          AND bucket BETWEEN ? AND ?
+                          """,
+                          (start_str, end_str)).fetchone()[0] or 0
+    if raw_count <= max_points:
+        return None
+
+    span = (t_end - t_start).total_seconds()
+    for resolution in RESOLUTIONS:
+        if span / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def backfill():
+    """
+    Rebuilds the rollups from the raw climate data still in the database, the older buckets are kept.
+    """
+    conn, c = _init_db(climatedb)
+    try:
+        c.executescript(f"BEGIN;\n{backfill_climate_rollup};\nCOMMIT;")
+    finally:
+        _close_db(conn, c)
+
+
+if __name__ == '__main__':
+    print("Rebuilding climate rollups...")
+    backfill()
+    print("Success.")
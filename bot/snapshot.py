@@ -0,0 +1,190 @@
+import calendar
+import math
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+"""
+Latest climate readings shared from the web process to the bot process without touching the database.
+The web process writes every saved reading into a shared memory segment which holds
+a ring buffer of the last readings, guarded by a seqlock:
+the writer makes the sequence number odd while writing and even again when done,
+so a reader knows to retry if the number was odd or changed while it was copying.
+The bot reads the segment and falls back to the database when it doesn't exist
+or hasn't been written for STALE_AFTER seconds, e.g. because the web process has died.
+"""
+
+SEGMENT_NAME = "kiltisbot_climate"
+# 24h of readings even when sampling every 10 seconds
+RING_SIZE = 8640
+HISTORY_SECONDS = 24 * 60 * 60
+# Seconds after the last write when the segment is no longer trusted
+STALE_AFTER = 15 * 60
+
+# sequence number, amount of readings in the ring, index of the next write, estimated people,
+# time of the last write (epoch)
+_HEADER = struct.Struct("<QQQdd")
+# epoch, co2, temperature, humidity
+_RECORD = struct.Struct("<dddd")
+SEGMENT_SIZE = _HEADER.size + RING_SIZE * _RECORD.size
+
+_reader = None
+
+
+def _untrack(shm):
+    """
+    Keeps the resource tracker from deleting the segment when a process exits.
+    The segment outlives both processes so a restarted bot or web process can keep using it.
+    """
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def to_epoch(timestamp):
+    """
+    Converts a database timestamp string (UTC) into a unix epoch.
+    """
+    return float(calendar.timegm(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")))
+
+
+def to_timestamp(epoch):
+    """
+    Converts a unix epoch into a database timestamp string (UTC).
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+class SnapshotWriter:
+    """
+    Owned by the web process. Only one thread may publish at a time.
+    """
+
+    def __init__(self, name=None):
+        # Looked up on creation so it can be changed, e.g. by benchmarks/loadtest.py
+        name = name or SEGMENT_NAME
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SEGMENT_SIZE)
+        except FileExistsError:
+            # Left behind by an earlier run, reusing it keeps the bot's mapping valid
+            self.shm = shared_memory.SharedMemory(name=name)
+            if self.shm.size < SEGMENT_SIZE:
+                # From an older version with a smaller layout
+                self.shm.unlink()
+                self.shm.close()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=SEGMENT_SIZE)
+        _untrack(self.shm)
+        self.seq, self.count, self.head, self.people, self.written = _HEADER.unpack_from(self.shm.buf, 0)
+        if not self.seq:
+            # A new segment, there's no estimate yet
+            self.people = math.nan
+            self._pack()
+        if self.seq % 2:
+            # The previous writer died in the middle of a write
+            self.seq += 1
+        self.latest = self._record(self.head - 1)[0] if self.count else 0.0
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self.shm.buf, _HEADER.size + (index % RING_SIZE) * _RECORD.size)
+
+    def publish(self, readings):
+        """
+        Adds Readings newer than the latest published one to the ring.
+        Readings without a timestamp are considered to be from right now.
+        """
+        records = []
+        for reading in readings:
+            epoch = to_epoch(reading.timestamp) if reading.timestamp else time.time()
+            if epoch > self.latest:
+                records.append((epoch, reading.co2, reading.temperature, reading.humidity))
+        if not records:
+            return
+        records.sort()
+
+        buf = self.shm.buf
+        self._begin()
+        for record in records[-RING_SIZE:]:
+            _RECORD.pack_into(buf, _HEADER.size + self.head * _RECORD.size, *record)
+            self.head = (self.head + 1) % RING_SIZE
+            self.count = min(self.count + 1, RING_SIZE)
+        self._end()
+        self.latest = records[-1][0]
+
+    def publish_people(self, people):
+        """
+        Shares the latest estimate of people at the guildroom.
+        """
+        self._begin()
+        self.people = people
+        self._end()
+
+    def _pack(self):
+        _HEADER.pack_into(self.shm.buf, 0, self.seq, self.count, self.head, self.people, self.written)
+
+    def _begin(self):
+        self.seq += 1
+        self._pack()
+
+    def _end(self):
+        self.seq += 1
+        self.written = time.time()
+        self._pack()
+
+    def close(self):
+        self.shm.close()
+
+
+def _attach():
+    """
+    Attaches the reader to the segment, returns None if the web process hasn't created it.
+    """
+    global _reader
+    if _reader is None:
+        try:
+            _reader = shared_memory.SharedMemory(name=SEGMENT_NAME)
+        except FileNotFoundError:
+            return None
+        _untrack(_reader)
+    return _reader
+
+
+def _read(copy=None, tries=100):
+    """
+    Returns a consistent copy of the header and whatever copy(buf, header) copies out of the segment,
+    so only the parts that are needed are copied.
+    Returns None if there is no segment, the writer kept it busy for too long or hasn't written it in STALE_AFTER seconds.
+    """
+    shm = _attach()
+    if shm is None:
+        return None
+    buf = shm.buf
+    for _ in range(tries):
+        header = _HEADER.unpack_from(buf, 0)
+        if header[0] % 2:
+            continue
+        data = copy(buf, header) if copy else None
+        if _HEADER.unpack_from(buf, 0)[0] == header[0]:
+            return (header, data) if time.time() - header[4] <= STALE_AFTER else None
+    return None
+
+
+def _latest_record(buf, header):
+    seq, count, head, people, written = header
+    return _RECORD.unpack_from(buf, _HEADER.size + ((head - 1) % RING_SIZE) * _RECORD.size) if count else None
+
+
+def latest():
+    """
+    Returns the latest reading as (epoch, co2, temperature, humidity) or None if it's not available.
+    """
+    result = _read(_latest_record)
+    return result[1] if result else None
+
+
+def people():
+    """
+    Returns the latest estimate of people at the guildroom or None if it's not available.
+    """
+    result = _read()
+    if result is None:
+        return None
+    seq, count, head, people, written = result[0]
+    return None if math.isnan(people) else people
@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+from logger import logger
+
+"""
+Live feed of the climate readings for the guildroom display and dashboards.
+Readings accepted by the web app are published to an in-memory hub, which fans them out
+to every subscriber of the /stream Server-Sent Events route without touching the database.
+Every subscriber has a bounded queue, a client too slow to keep up is dropped
+instead of letting its queue grow. EventSource clients reconnect by themselves.
+"""
+
+# Events waiting to be sent to one client before it's dropped
+CLIENT_QUEUE_SIZE = 100
+# Seconds between keepalive comments, lets proxies and dead connections time out
+HEARTBEAT = 15
+# Milliseconds a client should wait before reconnecting
+RETRY = 5000
+
+
+def encode(reading):
+    """
+    Formats a Reading as a Server-Sent Event.
+    """
+    return f"event: reading\ndata: {json.dumps(reading._asdict())}\n\n".encode()
+
+
+class StreamHub:
+    """
+    Publish-subscribe hub living in the web app's event loop.
+    """
+
+    def __init__(self, queue_size=CLIENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        """
+        Returns a new queue receiving every published event, None means the stream has ended.
+        """
+        q = asyncio.Queue(self.queue_size)
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        self._subscribers.discard(q)
+
+    def _end(self, q):
+        """
+        Ends the stream of a subscriber, throwing away whatever it hasn't received yet.
+        """
+        self._subscribers.discard(q)
+        while not q.empty():
+            q.get_nowait()
+        q.put_nowait(None)
+
+    def publish(self, readings):
+        """
+        Sends Readings to every subscriber. Each event is encoded only once.
+        Big batches (sensors catching up) are cut to their newest readings,
+        otherwise a single upload would be enough to drop every client.
+        """
+        if not self._subscribers:
+            return
+        events = [encode(reading) for reading in readings[-(self.queue_size // 2):]]
+        for q in list(self._subscribers):
+            if q.qsize() + len(events) > q.maxsize:
+                logger.info("Dropped a slow climate stream client")
+                self._end(q)
+                continue
+            for event in events:
+                q.put_nowait(event)
+
+    def close(self):
+        """
+        Ends the streams of all subscribers.
+        """
+        for q in list(self._subscribers):
+            self._end(q)
@@ -1,17 +1,21 @@
-import requests
 import html
 import random
 from telegram import Update, Poll
 from telegram.ext import ContextTypes
 
+import metrics
+
 
 async def trivia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Retrieves a random trivia quiz from an open database.
     Creates the quiz and sends it to the chat.
     """
+    import requests
+
     try:
-        response = requests.get("https://opentdb.com/api.php?amount=1&type=multiple")
+        with metrics.timed_http("trivia"):
+            response = requests.get("https://opentdb.com/api.php?amount=1&type=multiple")
         response.raise_for_status()
         data = response.json()
         question_data = data['results'][0]
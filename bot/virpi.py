@@ -1,16 +1,19 @@
-import sqlite3
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
 import config
-from db_utils import songdb, _init_db
+from db_utils import songdb, _init_db, _close_db
 from logger import logger
+from query_cache import QueryCache, fold_ascii
 
 """
 Implementation of songbook database and it's usage trhough telegram.
 Huge thanks to the Guild of Physics and their Fiisubot for inspiring and helping with this! <3
 """
 
+# search: names of the matching songs
+_search_cache = QueryCache("song")
+
 
 def _get_add_args(string):
     """
@@ -72,6 +75,14 @@ def _get_message_args(string):
 def _search_song(args):
     """
     Fetches possible matches based on song name and lyrics.
+    The results are cached until a song is added or deleted.
+    """
+    return _search_cache.get(fold_ascii(args.strip()), lambda: _find_songs(args))
+
+
+def _find_songs(args):
+    """
+    Returns the names of the first 5 songs whose name or lyrics contain args.
     """
     def like(string):
         return "%{}%".format(string)
@@ -98,7 +109,7 @@ def _search_song(args):
         for row in name_matches + lyric_matches:
             results.add(row[0])
     finally:
-        conn.close()
+        _close_db(conn, c)
 
     # Sorting may not be required. Could be easier to send the list as it was found.
     matches = sorted(results)
@@ -154,6 +165,7 @@ async def add_song(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         c.execute("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
                   (title, melody, writers, composers, song_number, page_number, lyrics))
         conn.commit()
+        _search_cache.invalidate()
         await update.message.reply_text(f"✅ Added song ✅\n"
                                         f"<i>'{title}'</i>",
                                         parse_mode="HTML")
@@ -165,7 +177,7 @@ async def add_song(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text(f"⚠️ Error while adding song ⚠️\n"
                                             f"{e}")
     finally:
-        conn.close()
+        _close_db(conn, c)
 
 
 async def send_long_message(update: Update, text: str) -> None:
@@ -320,7 +332,7 @@ async def get_song(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     finally:
-        conn.close()
+        _close_db(conn, c)
 
 
 async def delete_song(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -358,6 +370,7 @@ async def delete_song(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             """, (query,)).rowcount
         if deleted:
             conn.commit()
+            _search_cache.invalidate()
             await update.message.reply_text(f"🗑️ Song\n"
                                             f"<i>'{query}'</i>\n"
                                             f"deleted.",
@@ -378,4 +391,4 @@ async def delete_song(update: Update, context: ContextTypes.DEFAULT_TYPE):
                      "%s", e)
         await update.message.reply_text("❌ An error occurred while deleting the song ❌")
     finally:
-        conn.close()
+        _close_db(conn, c)
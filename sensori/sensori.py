@@ -1,9 +1,34 @@
+import gzip
+import json
+import os
 import time
 import requests
 import random
 
+"""
+Sensor client running on the raspberry at the guildroom.
+Every reading is first appended to a local spool file and then uploaded in gzip-compressed batches.
+The offset of the last reading the server has acknowledged is kept in a separate file,
+so nothing taken during a network or server outage (or a crash of this script) is lost:
+the upload simply resumes from that offset with an exponential backoff between failed tries.
+Every reading carries a sequence number and its timestamp, so the server saves a resent reading only once.
+"""
+
 API_KEY = "your_api_key_here"  # same as config.API_KEY on server
-SERVER_URL = "http://<server-ip>:8000/upload_sensor"  # change to real IP
+SERVER_URL = "http://<server-ip>:8000/upload_sensor/batch"  # change to real IP
+# Unique for every sensor sending to the same server. The server keeps one series for the room,
+# so a second sensor is only meant for replacing the first one, not for running alongside it.
+SENSOR_ID = 1
+
+SAMPLE_INTERVAL = 60  # seconds between readings
+SPOOL_PATH = "spool.jsonl"
+OFFSET_PATH = "spool.offset"
+SEQUENCE_PATH = "spool.sequence"
+# Readings per upload, the server accepts at most 1000
+BATCH_SIZE = 500
+# Seconds to wait after a failed upload, doubled after every failure up to MAX_BACKOFF
+MIN_BACKOFF = 5
+MAX_BACKOFF = 15 * 60
 
 
 def get_fake_sensor_data():
@@ -17,20 +42,197 @@ def get_fake_sensor_data():
     }
 
 
+def _fsync_dir(path):
+    """
+    Makes a rename or a new file in the directory of path survive a power cut.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def spool(reading):
+    """
+    Appends a reading to the spool and makes sure it's on the disk.
+    """
+    line = (json.dumps(reading) + "\n").encode()
+    with open(SPOOL_PATH, "ab+") as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                # Ends the line left half-written by a crash, so it doesn't swallow this reading
+                line = b"\n" + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_number(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_number(path, value):
+    """
+    Replaces a file holding a number atomically.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(value))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def read_sequence():
+    """
+    Returns the sequence number of the latest reading, 0 if there hasn't been any.
+    Stops the script if the file is there but can't be read, instead of quietly starting again from 1.
+    """
+    try:
+        with open(SEQUENCE_PATH) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Can't read the sequence number from {SEQUENCE_PATH}: {e}\n"
+                         f"Fix the file or remove it to start again from 1.")
+
+
+def next_sequence():
+    """
+    Returns the sequence number of a new reading.
+    It's saved before the reading is, so a number is never given out twice, even after a crash.
+    """
+    sequence = read_sequence() + 1
+    _write_number(SEQUENCE_PATH, sequence)
+    return sequence
+
+
+def read_offset():
+    """
+    Returns the offset of the first reading the server hasn't acknowledged.
+    """
+    offset = _read_number(OFFSET_PATH)
+    # The spool was truncated but the offset wasn't reset before a crash
+    size = os.path.getsize(SPOOL_PATH) if os.path.exists(SPOOL_PATH) else 0
+    return offset if offset <= size else 0
+
+
+def write_offset(offset):
+    """
+    Replaces the acknowledged offset atomically.
+    """
+    _write_number(OFFSET_PATH, offset)
+
+
+def read_batch(offset):
+    """
+    Returns up to BATCH_SIZE readings starting from offset and the offset after them.
+    A half-written last line (from a crash while appending) is left for later and
+    a line that isn't valid JSON is skipped.
+    """
+    readings = []
+    if not os.path.exists(SPOOL_PATH):
+        return readings, offset
+    with open(SPOOL_PATH, "rb") as f:
+        f.seek(offset)
+        while len(readings) < BATCH_SIZE:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                readings.append(json.loads(line))
+            except ValueError:
+                print(f"[{time.ctime()}] Skipped a broken line in the spool: {line!r}")
+    return readings, offset
+
+
+def compact(offset):
+    """
+    Empties the spool once the server has acknowledged everything in it.
+    """
+    if offset and offset == os.path.getsize(SPOOL_PATH):
+        with open(SPOOL_PATH, "r+") as f:
+            f.truncate(0)
+            os.fsync(f.fileno())
+        write_offset(0)
+        return 0
+    return offset
+
+
+def upload(session, readings):
+    """
+    Posts a batch of readings to the server.
+    Returns None on success or the seconds the server asked to wait before retrying.
+    Raises an exception on any other failure.
+    """
+    body = gzip.compress(json.dumps(readings).encode())
+    response = session.post(SERVER_URL, data=body, timeout=30, headers={"Content-Encoding": "gzip"})
+    if response.status_code == 503:
+        return int(response.headers.get("Retry-After", MIN_BACKOFF))
+    response.raise_for_status()
+    # Readings the server didn't accept would never be accepted, so they're acknowledged too
+    for reading, result in zip(readings, response.json().get("results", [])):
+        if result.get("status") == "error":
+            print(f"[{time.ctime()}] Server rejected {reading}: {result.get('error')}")
+    return None
+
+
 def send_data():
-    headers = {
+    # Refuses to start with a broken sequence file
+    read_sequence()
+    session = requests.Session()  # Keeps the connection to the server open between uploads
+    session.headers.update({
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
-    }
+    })
+    offset = read_offset()
+    next_sample = time.monotonic()
+    next_upload = time.monotonic()
+    backoff = MIN_BACKOFF
+
     while True:
-        sensor_data = get_fake_sensor_data()
-        try:
-            response = requests.post(SERVER_URL, json=sensor_data, headers=headers, timeout=5)
-            print(f"[{time.ctime()}] Sent data: {sensor_data} | Status: {response.status_code}")
-        except Exception as e:
-            print(f"[{time.ctime()}] Failed to send data: {e}")
-
-        time.sleep(180)  # every 3 minutes
+        now = time.monotonic()
+        if now >= next_sample:
+            sensor_data = get_fake_sensor_data()
+            sensor_data["timestamp"] = time.time()
+            sensor_data["sensor_id"] = SENSOR_ID
+            sensor_data["sequence"] = next_sequence()
+            spool(sensor_data)
+            next_sample += SAMPLE_INTERVAL
+
+        if now >= next_upload:
+            readings, end = read_batch(offset)
+            if readings or end != offset:
+                try:
+                    retry_after = upload(session, readings) if readings else None
+                except Exception as e:
+                    retry_after = backoff
+                    print(f"[{time.ctime()}] Failed to send {len(readings)} readings: {e}")
+                if retry_after is None:
+                    offset = compact(end)
+                    if offset:
+                        write_offset(offset)
+                    print(f"[{time.ctime()}] Sent {len(readings)} readings")
+                    backoff = MIN_BACKOFF
+                    # Keep going right away if there's more waiting in the spool
+                    next_upload = now if readings and len(readings) == BATCH_SIZE else next_sample
+                else:
+                    # Up to a quarter of randomness so a restarted server isn't hit by every client at once
+                    next_upload = now + retry_after * random.uniform(1.0, 1.25)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+            else:
+                next_upload = next_sample
+
+        time.sleep(max(0.0, min(next_sample, next_upload) - time.monotonic()))
 
 
 if __name__ == "__main__":